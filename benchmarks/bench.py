@@ -0,0 +1,261 @@
+"""
+    Benchmark of sqlmapper against raw sqlite3, no server is needed
+
+    python benchmarks/bench.py
+    python benchmarks/bench.py --mode memory --json result.json
+    python benchmarks/bench.py --compare old.json
+
+    Every case is run `repeat` times by `number` calls, the best run is taken (like timeit),
+    overhead is a ratio of sqlmapper time to raw sqlite3 time of the same statement.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlmapper
+from sqlmapper import Connection
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def books(rows, seed):
+    rnd = random.Random(seed)
+    book = [{'name': 'book{}'.format(i), 'value': rnd.randint(0, 1000), 'grp': i % 100} for i in range(rows)]
+    ref = [{'book_id': rnd.randint(1, rows), 'grp': i % 100} for i in range(rows)]
+    return book, ref
+
+
+def create_schema(db, rows, seed):
+    db.book.add_column('id', 'int', primary=True, auto_increment=True)
+    db.book.add_column('name', 'text')
+    db.book.add_column('value', 'int')
+    db.book.add_column('grp', 'int')
+    db.ref.add_column('id', 'int', primary=True, auto_increment=True)
+    db.ref.add_column('book_id', 'int')
+    db.ref.add_column('grp', 'int')
+    db.book.create_index('book_grp', 'grp')
+    db.ref.create_index('ref_grp', 'grp')
+
+    book, ref = books(rows, seed)
+    db.book.insert_many(book)
+    db.ref.insert_many(ref)
+    db.commit()
+
+
+def create_raw_schema(conn, rows, seed):
+    conn.execute('CREATE TABLE book (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, value INTEGER, grp INTEGER)')
+    conn.execute('CREATE TABLE ref (id INTEGER PRIMARY KEY AUTOINCREMENT, book_id INTEGER, grp INTEGER)')
+    conn.execute('CREATE INDEX book_grp ON book (grp)')
+    conn.execute('CREATE INDEX ref_grp ON ref (grp)')
+    book, ref = books(rows, seed)
+    conn.executemany('INSERT INTO book (name, value, grp) VALUES (?, ?, ?)', [(r['name'], r['value'], r['grp']) for r in book])
+    conn.executemany('INSERT INTO ref (book_id, grp) VALUES (?, ?)', [(r['book_id'], r['grp']) for r in ref])
+    conn.commit()
+
+
+class Case(object):
+    def __init__(self, name, mapper, raw, rows=1):
+        self.name = name
+        self.mapper = mapper
+        self.raw = raw
+        self.rows = rows
+
+
+def get_cases(db, conn, rows):
+    cursor = conn.cursor()
+    ids = [random.Random(i).randint(1, rows) for i in range(1000)]
+    # rows of a group (grp = i % 100), at least one for us/row
+    group_size = max(rows // 100, 1)
+    state = {'i': 0}
+
+    def next_id():
+        state['i'] += 1
+        return ids[state['i'] % len(ids)]
+
+    def mapper_insert():
+        db.book.insert({'name': 'new', 'value': 1, 'grp': 0})
+
+    def raw_insert():
+        cursor.execute('INSERT INTO book (name, value, grp) VALUES (?, ?, ?)', ('new', 1, 0))
+
+    def mapper_find_one():
+        db.book.find_one(next_id())
+
+    def raw_find_one():
+        cursor.execute('SELECT * FROM book WHERE id = ? LIMIT 1', (next_id(),))
+        cursor.fetchall()
+
+    def mapper_find():
+        list(db.book.find({'grp': next_id() % 100}))
+
+    def raw_find():
+        cursor.execute('SELECT * FROM book WHERE grp = ?', (next_id() % 100,))
+        cursor.fetchall()
+
+    def mapper_find_join():
+        list(db.ref.find(('ref.grp = ?', next_id() % 100), join='book.id=book_id'))
+
+    def raw_find_join():
+        cursor.execute('SELECT ref.*, book.* FROM ref JOIN book ON book.id = ref.book_id WHERE ref.grp = ?', (next_id() % 100,))
+        cursor.fetchall()
+
+    def mapper_update():
+        db.book.update(next_id(), {'value': 5})
+
+    def raw_update():
+        cursor.execute('UPDATE book SET value = ? WHERE id = ?', (5, next_id()))
+
+    def mapper_count():
+        db.book.count({'grp': next_id() % 100})
+
+    def raw_count():
+        cursor.execute('SELECT COUNT(*) FROM book WHERE grp = ?', (next_id() % 100,))
+        cursor.fetchone()
+
+    return [
+        Case('insert', mapper_insert, raw_insert),
+        Case('find_one_pk', mapper_find_one, raw_find_one),
+        Case('find', mapper_find, raw_find, rows=group_size),
+        Case('find_join', mapper_find_join, raw_find_join, rows=group_size),
+        Case('update', mapper_update, raw_update),
+        Case('count', mapper_count, raw_count)
+    ]
+
+
+def measure(fn, number, repeat, commit):
+    best = None
+    for _ in range(repeat):
+        start = clock()
+        for _ in range(number):
+            fn()
+        elapsed = clock() - start
+        commit()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / number
+
+
+def result_of(seconds, rows):
+    return {
+        'ops': 1.0 / seconds if seconds else 0,
+        'us_per_op': seconds * 1e6,
+        'us_per_row': seconds * 1e6 / rows
+    }
+
+
+def run_mode(mode, rows, number, repeat, seed):
+    tmp = None
+    if mode == 'memory':
+        db = Connection(engine='sqlite')
+        conn = sqlite3.connect(':memory:')
+    else:
+        tmp = tempfile.mkdtemp(prefix='sqlmapper_bench')
+        db = Connection(engine='sqlite', db=os.path.join(tmp, 'mapper.db'), synchronous='normal')
+        conn = sqlite3.connect(os.path.join(tmp, 'raw.db'))
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+
+    try:
+        create_schema(db, rows, seed)
+        create_raw_schema(conn, rows, seed)
+
+        result = {}
+        for case in get_cases(db, conn, rows):
+            # warm up caches of both sides
+            measure(case.mapper, max(number // 10, 1), 1, db.commit)
+            measure(case.raw, max(number // 10, 1), 1, conn.commit)
+            mapper = measure(case.mapper, number, repeat, db.commit)
+            raw = measure(case.raw, number, repeat, conn.commit)
+            result[case.name] = {
+                'sqlmapper': result_of(mapper, case.rows),
+                'raw': result_of(raw, case.rows),
+                'rows': case.rows,
+                'overhead': mapper / raw if raw else None
+            }
+        return result
+    finally:
+        db.close()
+        conn.close()
+        if tmp:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def compare(old, new, threshold):
+    regressions = []
+    for mode, cases in new['results'].items():
+        for name, r in cases.items():
+            prev = old.get('results', {}).get(mode, {}).get(name)
+            if not prev:
+                continue
+            before = prev['sqlmapper']['us_per_op']
+            after = r['sqlmapper']['us_per_op']
+            change = (after - before) / before if before else 0
+            mark = ''
+            if change > threshold:
+                mark = ' REGRESSION'
+                regressions.append((mode, name, change))
+            print('{:8} {:12} {:10.2f} -> {:10.2f} us {:+7.1%}{}'.format(mode, name, before, after, change, mark))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sqlmapper vs sqlite3 benchmark')
+    parser.add_argument('--mode', choices=['memory', 'file', 'all'], default='all')
+    parser.add_argument('--rows', type=int, default=10000, help='rows in a table')
+    parser.add_argument('--number', type=int, default=1000, help='calls in a run')
+    parser.add_argument('--repeat', type=int, default=5, help='runs, the best one is taken')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write results to a file')
+    parser.add_argument('--compare', help='compare with results of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+    if args.rows < 1:
+        parser.error('--rows has to be positive')
+
+    modes = ['memory', 'file'] if args.mode == 'all' else [args.mode]
+    report = {
+        'meta': {
+            'sqlmapper': sqlmapper.__version__,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'rows': args.rows,
+            'number': args.number,
+            'repeat': args.repeat,
+            'seed': args.seed
+        },
+        'results': {}
+    }
+
+    for mode in modes:
+        result = report['results'][mode] = run_mode(mode, args.rows, args.number, args.repeat, args.seed)
+        print('{} ({} rows)'.format(mode, args.rows))
+        print('  {:12} {:>12} {:>12} {:>12} {:>9}'.format('case', 'ops/s', 'us/op', 'us/row', 'overhead'))
+        for name, r in result.items():
+            m = r['sqlmapper']
+            print('  {:12} {:12.0f} {:12.2f} {:12.3f} {:8.2f}x'.format(name, m['ops'], m['us_per_op'], m['us_per_row'], r['overhead'] or 0))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if compare(old, report, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
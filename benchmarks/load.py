@@ -0,0 +1,330 @@
+"""
+    Load harness: throughput, tail latencies and lock wait by concurrency
+
+    python benchmarks/load.py                                  # SQLite file database, threads
+    python benchmarks/load.py --engine mysql --workers 1,4,16,64 --mix counter
+    python benchmarks/load.py --engine all --asyncio --json load.json
+
+    Mixes:
+        counter - hot-row counter: SELECT ... FOR UPDATE + UPDATE + COMMIT (increment on SQLite)
+        read - find_one by primary key
+        insert - insert_many of a batch + COMMIT
+        mixed - 80% read, 10% counter, 10% insert
+
+    Lock wait is the time of taking the row lock (the locking SELECT, or the first write on SQLite
+    which waits for the writer). --engine all runs SQLite and MySQL/PostgreSQL servers which are reachable.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlmapper import Connection
+from sqlmapper.instrument import Histogram
+
+clock = getattr(time, 'perf_counter', time.time)
+
+mixes = {
+    'counter': [('counter', 1)],
+    'read': [('read', 1)],
+    'insert': [('insert', 1)],
+    'mixed': [('read', 8), ('counter', 1), ('insert', 1)]
+}
+
+
+class Stats(object):
+    def __init__(self):
+        self.latency = {}  # op -> Histogram of microseconds
+        self.lock_wait = 0.0
+        self.ops = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def add(self, op, seconds, lock_wait=0.0):
+        with self.lock:
+            h = self.latency.get(op)
+            if h is None:
+                h = self.latency[op] = Histogram()
+            h.record(seconds * 1e6)
+            self.ops += 1
+            self.lock_wait += lock_wait
+
+    def error(self):
+        with self.lock:
+            self.errors += 1
+
+    def result(self, duration, workers):
+        total = Histogram()
+        for h in self.latency.values():
+            total.merge(h)
+        return {
+            'workers': workers,
+            'ops': self.ops,
+            'errors': self.errors,
+            'throughput': self.ops / duration,
+            'lock_wait_s': self.lock_wait,
+            'lock_wait_per_op_us': self.lock_wait * 1e6 / self.ops if self.ops else 0,
+            'latency_us': percentiles(total),
+            'by_op': dict((op, percentiles(h)) for op, h in self.latency.items())
+        }
+
+
+def percentiles(h):
+    return {
+        'count': h.count,
+        'p50': h.percentile(50),
+        'p95': h.percentile(95),
+        'p99': h.percentile(99),
+        'p999': h.percentile(99.9),
+        'max': h.max
+    }
+
+
+def pick(mix, rnd):
+    total = sum(w for _, w in mix)
+    n = rnd.uniform(0, total)
+    for op, weight in mix:
+        n -= weight
+        if n <= 0:
+            return op
+    return mix[-1][0]
+
+
+class Target(object):
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.tmp = None
+
+    def options(self):
+        a = self.args
+        if self.name == 'sqlite':
+            if self.tmp is None:
+                self.tmp = tempfile.mkdtemp(prefix='sqlmapper_load')
+            return {'engine': 'sqlite', 'db': os.path.join(self.tmp, 'load.db'), 'synchronous': 'normal', 'timeout': 30}
+        opt = {'host': a.host, 'db': a.db, 'autocreate': True, 'read_commited': True}
+        if self.name == 'mysql':
+            opt.update(engine='mysql', user=a.user or 'root')
+        else:
+            opt.update(engine='postgresql', user=a.user or 'postgres')
+        if a.password:
+            opt['password'] = a.password
+        return opt
+
+    def connect(self):
+        return Connection(**self.options())
+
+    def available(self):
+        try:
+            self.connect().close()
+            return True
+        except Exception as e:
+            print('{}: skipped, {}'.format(self.name, e))
+            return False
+
+    def setup(self, hot_rows, rows):
+        db = self.connect()
+        for name in ('load_counter', 'load_item'):
+            db[name].drop()
+        db.commit()
+        db.load_counter.add_column('id', 'int', primary=True, auto_increment=True)
+        db.load_counter.add_column('value', 'int')
+        db.load_item.add_column('id', 'int', primary=True, auto_increment=True)
+        db.load_item.add_column('value', 'int')
+        db.load_counter.insert_many([{'value': 0} for _ in range(hot_rows)])
+        db.load_item.insert_many([{'value': i} for i in range(rows)])
+        db.commit()
+        db.close()
+
+    def cleanup(self):
+        if self.tmp:
+            shutil.rmtree(self.tmp, ignore_errors=True)
+            self.tmp = None
+
+
+def run_op(db, op, rnd, args, sqlite):
+    # returns lock wait
+    if op == 'read':
+        db.load_item.find_one(rnd.randint(1, args.rows))
+        return 0.0
+    if op == 'insert':
+        db.load_item.insert_many([{'value': rnd.randint(0, 1000)} for _ in range(args.batch)])
+        db.commit()
+        return 0.0
+
+    key = rnd.randint(1, args.hot_rows)
+    start = clock()
+    if sqlite:
+        # no row locks, a write waits for the writer connection
+        db.load_counter.increment(key, 'value')
+        wait = clock() - start
+    else:
+        row = db.load_counter.find_one(key, for_update=True)
+        wait = clock() - start
+        db.load_counter.update(key, {'value': row['value'] + 1})
+    db.commit()
+    return wait
+
+
+def run_threads(target, workers, args):
+    db = target.connect()
+    stats = Stats()
+    mix = mixes[args.mix]
+    deadline = clock() + args.duration
+    sqlite = target.name == 'sqlite'
+
+    def worker(n):
+        rnd = random.Random(args.seed + n)
+        while clock() < deadline:
+            op = pick(mix, rnd)
+            start = clock()
+            try:
+                wait = run_op(db, op, rnd, args, sqlite)
+            except Exception:
+                stats.error()
+                try:
+                    db.rollback()
+                except Exception:
+                    pass
+                continue
+            stats.add(op, clock() - start, wait)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(workers)]
+    start = clock()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    result = stats.result(clock() - start, workers)
+    db.close()
+    return result
+
+
+def run_asyncio(target, workers, args):
+    import asyncio
+    from sqlmapper.aio import Connection as AsyncConnection
+
+    async def main():
+        opt = target.options()
+        opt.pop('autocreate', None)
+        db = await AsyncConnection(pool_size=workers, **opt)
+        stats = Stats()
+        mix = mixes[args.mix]
+        deadline = clock() + args.duration
+
+        async def op_run(op, rnd):
+            if op == 'read':
+                await db.load_item.find_one(rnd.randint(1, args.rows))
+                return 0.0
+            if op == 'insert':
+                async with db.transaction():
+                    await db.load_item.insert_many([{'value': rnd.randint(0, 1000)} for _ in range(args.batch)])
+                return 0.0
+            key = rnd.randint(1, args.hot_rows)
+            async with db.transaction():
+                start = clock()
+                row = await db.load_counter.find_one(key, for_update=True)
+                wait = clock() - start
+                await db.load_counter.update(key, {'value': row['value'] + 1})
+            return wait
+
+        async def worker(n):
+            rnd = random.Random(args.seed + n)
+            while clock() < deadline:
+                op = pick(mix, rnd)
+                start = clock()
+                try:
+                    wait = await op_run(op, rnd)
+                except Exception:
+                    stats.error()
+                    continue
+                stats.add(op, clock() - start, wait)
+
+        start = clock()
+        await asyncio.gather(*[worker(n) for n in range(workers)])
+        result = stats.result(clock() - start, workers)
+        db.close()
+        return result
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+
+def knee(results):
+    # the first concurrency level which adds less than 10% of throughput
+    for prev, cur in zip(results, results[1:]):
+        if cur['throughput'] < prev['throughput'] * 1.1:
+            return prev['workers']
+    return None
+
+
+def report(title, results):
+    print(title)
+    print('  {:>7} {:>10} {:>8} {:>9} {:>9} {:>9} {:>10} {:>12}'.format('workers', 'ops/s', 'errors', 'p50 us', 'p99 us', 'p999 us', 'max us', 'lock us/op'))
+    for r in results:
+        lat = r['latency_us']
+        print('  {:7} {:10.0f} {:8} {:9} {:9} {:9} {:10} {:12.1f}'.format(
+            r['workers'], r['throughput'], r['errors'], lat['p50'], lat['p99'], lat['p999'], lat['max'], r['lock_wait_per_op_us']))
+    level = knee(results)
+    if level:
+        print('  throughput stops scaling after {} workers'.format(level))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sqlmapper load harness')
+    parser.add_argument('--engine', choices=['sqlite', 'mysql', 'postgresql', 'all'], default='sqlite')
+    parser.add_argument('--mix', choices=sorted(mixes), default='mixed')
+    parser.add_argument('--workers', default='1,2,4,8,16', help='concurrency levels')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per level')
+    parser.add_argument('--asyncio', action='store_true', help='also run asyncio workers (sqlmapper.aio, MySQL)')
+    parser.add_argument('--hot-rows', type=int, default=1, help='rows of the counter table')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--batch', type=int, default=100, help='rows of a bulk insert')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--db', default='sqlmapper_load')
+    parser.add_argument('--user')
+    parser.add_argument('--password')
+    parser.add_argument('--json', help='write results to a file')
+    args = parser.parse_args()
+
+    levels = [int(n) for n in args.workers.split(',')]
+    names = ['sqlite', 'mysql', 'postgresql'] if args.engine == 'all' else [args.engine]
+    output = {'mix': args.mix, 'duration': args.duration, 'results': {}}
+
+    for name in names:
+        target = Target(name, args)
+        try:
+            if not target.available():
+                continue
+            modes = [('threads', run_threads)]
+            if args.asyncio and name == 'mysql':
+                modes.append(('asyncio', run_asyncio))
+            for mode, run in modes:
+                results = []
+                for workers in levels:
+                    target.setup(args.hot_rows, args.rows)
+                    results.append(run(target, workers, args))
+                output['results']['{}/{}'.format(name, mode)] = results
+                report('{} {} ({})'.format(name, mode, args.mix), results)
+        finally:
+            target.cleanup()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,10 @@
 
 from __future__ import absolute_import
 from .connection import Connection
+from .row import Row
+from .queue import TableQueue
+from .instrument import Collector, QueryEvent, SlowQueryLog
+from .cache import MemoryCache
 
 
 __version__ = '0.3.5'
@@ -3,7 +3,7 @@ import asyncio
 
 async def Connection(**kw):
     engine = kw.pop('engine', None) or 'mysql'
-    loop = kw.pop('engine', None) or asyncio.get_event_loop()
+    loop = kw.pop('loop', None) or asyncio.get_event_loop()
 
     if engine == 'mysql':
         from .amysql import Engine
@@ -41,25 +41,26 @@ class AsyncConnection:
     
     def on_rollback(self, fn):
         self._engine.on_rollback(fn)
+
+    def add_listener(self, fn):
+        self._engine.add_listener(fn)
+
+    def remove_listener(self, fn):
+        self._engine.remove_listener(fn)
     
     @property
     def cursor(self):
         return self._engine.cursor
 
-    '''
-    def __enter__(self):
-        self._engine.local.contextlvl += 1
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        self._engine.local.contextlvl -= 1
-        if not self._engine.local.contextlvl:
-            if exc_type:
-                self.rollback()
-            else:
-                self.commit()
-        if exc_type:
-            return False
-    '''
+    def transaction(self):
+        return self._engine.transaction()
+
+    async def __aenter__(self):
+        await self._engine.transaction().__aenter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        return await self._engine.transaction().__aexit__(exc_type, exc_value, traceback)
+
 
 class DBList:
     def __init__(self, engine):
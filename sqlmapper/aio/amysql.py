@@ -1,17 +1,38 @@
-
-import copy
+import asyncio
+import contextvars
 import re
 import aiomysql
 from pymysql.err import InternalError, OperationalError
-from ..utils import validate_name, NoValue, quote_key, format_func
+from ..base_engine import MultiException
+from ..instrument import QueryEvent, clock, emit
+from ..row import make_decoder
+from ..schema import SchemaCache
+from ..table import lock_modes
+from ..utils import validate_name, NoValue, quote_key, format_func, iter_batches, freeze, LRUCache
 
 
 class Engine:
     def __init__(self):
         self.cursors = []
-        self.local = type('local', (object,), {'tables': {}})()
-
-    async def init(self, *, loop, read_commited=False, autocreate=False, **kw):
+        self.sql_cache = LRUCache()
+        self.schema_cache = SchemaCache()
+        self.table_objects = {}
+        self.connection = None
+        self.pool = None
+        self.semaphore = None
+        self.max_queries = None
+        self.borrowed = {}
+        self.streams = {}  # id(cursor) -> (connection, task) of an open unbuffered result
+        self.tx = contextvars.ContextVar('sqlmapper_tx', default=None)
+        self.tx_lock = asyncio.Lock()
+        self.hooks = {True: [], False: []}
+        self.listeners = ()
+
+    async def init(self, *, loop, read_commited=False, autocreate=False, pool_size=None, pool_minsize=1, max_queries=None, **kw):
+        """
+            pool_size - use a pool of connections, queries out of a transaction are run in autocommit mode
+            max_queries - limit of queries in flight
+        """
         self.loop = loop
         self.read_commited = read_commited
 
@@ -23,8 +44,20 @@ class Engine:
         if 'charset' not in option:
             option['charset'] = 'utf8mb4'
 
+        self.max_queries = max_queries
+        if max_queries:
+            self.semaphore = asyncio.Semaphore(max_queries)
+
+        if pool_size:
+            pool_option = dict(option, minsize=pool_minsize, maxsize=pool_size, autocommit=True)
+            if read_commited:
+                pool_option['init_command'] = 'SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED'
+            connect = lambda opt: aiomysql.create_pool(loop=loop, **dict(pool_option, **opt))
+        else:
+            connect = lambda opt: aiomysql.connect(loop=loop, **dict(option, **opt))
+
         try:
-            self.connection = await aiomysql.connect(loop=loop, **option)
+            result = await connect({})
         except OperationalError as e:
             if autocreate and e.args[0] == 2003 and isinstance(e.__cause__, InternalError) and e.__cause__.args[0] == 1049:
                 # Unknown database
@@ -38,30 +71,158 @@ class Engine:
                     await cursor.close()
                     connection.close()
 
-                self.connection = await aiomysql.connect(loop=loop, **option)
+                result = await connect({})
             else:
                 raise
 
+        if pool_size:
+            self.pool = result
+        else:
+            self.connection = result
+
+    def transaction(self):
+        return TransactionContext(self)
+
     async def commit(self):
-        await self.connection.commit()
+        tx = self.tx.get()
+        if tx is not None:
+            await tx.conn.commit()
+        elif self.pool is None:
+            await self.connection.commit()
+        self.fire_event(True)
 
     async def rollback(self):
-        await self.connection.rollback()
+        tx = self.tx.get()
+        if tx is not None:
+            await tx.conn.rollback()
+        elif self.pool is None:
+            await self.connection.rollback()
+        self.fire_event(False)
+
+    def on_commit(self, fn):
+        tx = self.tx.get()
+        (tx.hooks if tx is not None else self.hooks)[True].append(fn)
+
+    def on_rollback(self, fn):
+        tx = self.tx.get()
+        (tx.hooks if tx is not None else self.hooks)[False].append(fn)
+
+    def fire_event(self, success):
+        tx = self.tx.get()
+        hooks = tx.hooks if tx is not None else self.hooks
+        fnlist = hooks[success]
+        hooks[True] = []
+        hooks[False] = []
+        exceptions = []
+        for fn in fnlist:
+            try:
+                fn()
+            except Exception as e:
+                exceptions.append(e)
+        if exceptions:
+            if len(exceptions) == 1:
+                raise exceptions[0]
+            else:
+                raise MultiException(exceptions)
+
+    def add_listener(self, fn):
+        # fn(QueryEvent) is called after every statement
+        self.listeners = list(self.listeners) + [fn]
+
+    def remove_listener(self, fn):
+        self.listeners = [l for l in self.listeners if l is not fn]
+
+    def emit(self, event):
+        emit(self.listeners, event)
+
+    def new_event(self, sql, argv, table=None, operation=None, started=None):
+        if not self.listeners:
+            return None
+        event = QueryEvent(sql, argv, table, operation)
+        if started is not None:
+            event.build_time = clock() - started
+        return event
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+        elif self.connection:
+            self.connection.close()
 
-    async def acquare_cursor(self):
-        if self.cursors:
-            return self.cursors.pop()
+    def check_streams(self, tx):
+        # a query on a connection which is read by iterate() fails with "Commands out of sync",
+        # a query nested in iterate() waits forever for the only slot of max_queries=1
+        if not self.streams:
+            return
+        if tx is not None:
+            conn = tx.conn
+        elif self.pool is None:
+            conn = self.connection
+        else:
+            conn = None
+        task = asyncio.current_task()
+        for stream_conn, stream_task in self.streams.values():
+            if stream_conn is conn:
+                raise RuntimeError('The connection is busy with iterate(), read it to the end or close it first')
+            if stream_task is task and self.max_queries == 1:
+                raise RuntimeError('No free slot of max_queries for a query nested in iterate()')
+
+    async def acquare_cursor(self, cursor_class=None):
+        tx = self.tx.get()
+        self.check_streams(tx)
+        if self.semaphore:
+            await self.semaphore.acquire()
+        try:
+            if tx is not None:
+                return await tx.conn.cursor(cursor_class) if cursor_class else await tx.conn.cursor()
 
-        cursor = await self.connection.cursor()
-        if self.read_commited:
-            await cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
-        return cursor
+            if self.pool is not None:
+                conn = await self.pool.acquire()
+                try:
+                    cursor = await conn.cursor(cursor_class) if cursor_class else await conn.cursor()
+                except Exception:
+                    self.pool.release(conn)
+                    raise
+                self.borrowed[id(cursor)] = conn
+                return cursor
+
+            if cursor_class:
+                return await self.connection.cursor(cursor_class)
+
+            if self.cursors:
+                return self.cursors.pop()
+
+            cursor = await self.connection.cursor()
+            if self.read_commited:
+                await cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+            return cursor
+        except Exception:
+            if self.semaphore:
+                self.semaphore.release()
+            raise
 
     def release_cursor(self, cursor):
-        if not cursor.closed:
+        self.streams.pop(id(cursor), None)
+        conn = self.borrowed.pop(id(cursor), None)
+        if conn is not None:
+            self.pool.release(conn)
+        elif self.pool is None and not cursor.closed and self.tx.get() is None and not isinstance(cursor, aiomysql.SSCursor):
             self.cursors.append(cursor)
+        if self.semaphore:
+            self.semaphore.release()
+
+    async def stream_cursor(self):
+        # unbuffered cursor, the result has to be read or closed before the next query on the connection,
+        # it has to be returned by release_cursor
+        cursor = await self.acquare_cursor(aiomysql.SSCursor)
+        self.streams[id(cursor)] = (cursor.connection, asyncio.current_task())
+        return cursor
 
     async def reconnect(self):
+        if self.pool is not None:
+            # a broken connection is dropped by the pool on release
+            return
+
         for cursor in self.cursors:
             await cursor.close()
         self.cursors = []
@@ -75,36 +236,120 @@ class Engine:
     def cursor(self):
         return CursorContext(self)
 
-    def try_execute(self, query, argv=None):
-        return TryExecuteContext(self, query, argv)
+    def try_execute(self, query, argv=None, table=None, operation=None, started=None):
+        return TryExecuteContext(self, query, argv, table, operation, started)
 
     def get_table(self, name):
-        return Table(name, self)
+        table = self.table_objects.get(name)
+        if table is None:
+            table = self.table_objects[name] = Table(name, self)
+        return table
 
     async def get_tables(self):
         result = []
-        async with self.try_execute('SHOW TABLES') as cursor:
+        async with self.try_execute('SHOW TABLES', operation='schema') as cursor:
             for row in await cursor.fetchall():
                 result.append(row[0])
         return result
 
+    async def load_columns(self, table):
+        result = []
+        async with self.try_execute('describe `{}`'.format(table), table=table, operation='schema') as cursor:
+            for row in await cursor.fetchall():
+                result.append({
+                    'name': row[0],
+                    'type': row[1],
+                    'null': row[2] == 'YES',
+                    'default': row[4],
+                    'primary': row[3] == 'PRI',
+                    'auto_increment': row[5] == 'auto_increment'
+                })
+        return result
+
+    async def get_schema(self, table):
+        schema = self.schema_cache.get(table)
+        if schema is None:
+            schema = self.schema_cache.set(table, await self.load_columns(table))
+        return schema
+
     async def get_columns(self, table):
-        result = self.local.tables.get(table)
-        if not result:
-            result = []
-            async with self.try_execute('describe `{}`'.format(table)) as cursor:
-                for row in await cursor.fetchall():
-                    result.append({
-                        'name': row[0],
-                        'type': row[1],
-                        'null': row[2] == 'YES',
-                        'default': row[4],
-                        'primary': row[3] == 'PRI',
-                        'auto_increment': row[5] == 'auto_increment'
-                    })
-
-            self.local.tables[table] = result
-        return copy.deepcopy(result)
+        return (await self.get_schema(table)).columns
+
+    def refresh_schema(self, table=None):
+        self.schema_cache.invalidate(table)
+        self.sql_cache.clear()
+
+
+class Transaction:
+    def __init__(self, engine):
+        self.engine = engine
+        self.conn = None
+        self.level = 0
+        self.hooks = {True: [], False: []}
+
+    async def begin(self):
+        engine = self.engine
+        if engine.pool is None:
+            # one connection, transactions are run one by one
+            await engine.tx_lock.acquire()
+            self.conn = engine.connection
+        else:
+            self.conn = await engine.pool.acquire()
+            try:
+                await self.conn.autocommit(False)
+            except Exception:
+                engine.pool.release(self.conn)
+                raise
+        await self.conn.begin()
+
+    async def close(self):
+        engine = self.engine
+        if engine.pool is None:
+            engine.tx_lock.release()
+            return
+        try:
+            await self.conn.autocommit(True)
+        except Exception:
+            self.conn.close()
+        engine.pool.release(self.conn)
+
+
+class TransactionContext:
+    """
+        async with db.transaction():
+        Pins a connection of the pool for the block, commits on exit or rolls back on an exception
+    """
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def __aenter__(self):
+        engine = self.engine
+        tx = engine.tx.get()
+        if tx is not None:
+            tx.level += 1
+            return tx
+
+        tx = Transaction(engine)
+        await tx.begin()
+        engine.tx.set(tx)
+        return tx
+
+    async def __aexit__(self, exc_type, exc, tb):
+        engine = self.engine
+        tx = engine.tx.get()
+        if tx.level:
+            tx.level -= 1
+            return False
+
+        try:
+            if exc_type:
+                await engine.rollback()
+            else:
+                await engine.commit()
+        finally:
+            engine.tx.set(None)
+            await tx.close()
+        return False
 
 
 class CursorContext:
@@ -120,42 +365,99 @@ class CursorContext:
 
 
 class TryExecuteContext:
-    def __init__(self, engine, query, argv):
+    def __init__(self, engine, query, argv, table=None, operation=None, started=None):
         self.engine = engine
         self.query = query
         self.argv = argv
+        self.event = engine.new_event(query, argv, table, operation, started)
+
+    async def execute(self, cursor):
+        event = self.event
+        if event is None:
+            await cursor.execute(self.query, self.argv)
+            return
+        start = clock()
+        try:
+            await cursor.execute(self.query, self.argv)
+        finally:
+            event.db_time += clock() - start
 
     async def run(self):
+        try:
+            return await self._run()
+        except Exception as e:
+            if self.event is not None:
+                self.event.error = e
+                self.engine.emit(self.event)
+            raise
+
+    async def _run(self):
         cursor = await self.engine.acquare_cursor()
         try:
-            await cursor.execute(self.query, self.argv)
+            await self.execute(cursor)
         except OperationalError as e:
             self.engine.release_cursor(cursor)
-            if e.args[0] == 2013:
+            if e.args[0] == 2013 and self.engine.tx.get() is None:
                 await self.engine.reconnect()
                 cursor = await self.engine.acquare_cursor()
                 try:
-                    await cursor.execute(self.query, self.argv)
+                    await self.execute(cursor)
                 except Exception:
                     self.engine.release_cursor(cursor)
                     raise
             else:
                 raise
+        except Exception:
+            self.engine.release_cursor(cursor)
+            raise
 
         return cursor
 
+    def finish(self, cursor):
+        event = self.event
+        if event is not None:
+            if not event.rows:
+                event.rows = cursor.rowcount
+            self.engine.emit(event)
+
     async def __aenter__(self):
         self.cursor = await self.run()
         return self.cursor
 
     async def __aexit__(self, exc_type, exc, tb):
+        self.finish(self.cursor)
         self.engine.release_cursor(self.cursor)
 
     async def __call__(self):
-        self.engine.release_cursor(await self.run())
+        cursor = await self.run()
+        self.finish(cursor)
+        self.engine.release_cursor(cursor)
+
+
+class RowIterator:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self.rows.__anext__()
+
+    async def aclose(self):
+        await self.rows.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
 
 
 class Table:
+    max_params = 65535
+    max_packet = 1 << 22
+
     def __init__(self, name, engine):
         self.tablename = name
         self.engine = engine
@@ -165,16 +467,26 @@ class Table:
     def cursor(self):
         return self.engine.cursor
 
-    def try_execute(self, query, argv=None):
-        return self.engine.try_execute(query, argv)
+    def try_execute(self, query, argv=None, operation=None, started=None):
+        return self.engine.try_execute(query, argv, self.tablename, operation, started)
+
+    def _started(self):
+        # start of a call, time of building sql is measured only for listeners
+        if self.engine.listeners:
+            return clock()
 
     async def describe(self):
         return await self.engine.get_columns(self.tablename)
 
     async def get_column(self, name):
-        for column in await self.describe():
-            if column['name'] == name:
-                return column
+        return (await self.engine.get_schema(self.tablename)).index.get(name)
+
+    async def get_primary_key(self):
+        return (await self.engine.get_schema(self.tablename)).primary
+
+    def refresh(self):
+        # drops cached schema of the table
+        self.engine.refresh_schema(self.tablename)
 
     async def add_column(self, name, column_type, not_null=False, default=NoValue, exist_ok=False, primary=False, auto_increment=False, collate=None):
         validate_name(name)
@@ -214,10 +526,11 @@ class Table:
             charset = collate.split('_')[0]
             sql = 'CREATE TABLE `{}` ({}) ENGINE=InnoDB DEFAULT CHARSET {} COLLATE {}'.format(self.tablename, scolumn, charset, collate)
 
-        await self.try_execute(sql, tuple(values))()
-        self.engine.local.tables[self.tablename] = None
+        await self.try_execute(sql, tuple(values), 'ddl')()
+        self.engine.refresh_schema(self.tablename)
 
     async def insert(self, data):
+        started = self._started()
         keys = []
         values = []
         items = []
@@ -227,53 +540,211 @@ class Table:
             items.append(self.keyword)
 
         sql = 'INSERT INTO `{}` ({}) VALUES ({})'.format(self.tablename, ', '.join(keys), ', '.join(items))
-        async with self.try_execute(sql, tuple(values)) as cursor:
+        async with self.try_execute(sql, tuple(values), 'insert', started) as cursor:
             assert cursor.rowcount == 1
             return cursor.lastrowid
 
-    async def _build_filter(self, filter):
+    async def insert_many(self, rows, batch_size=1000):
+        result = []
+        for batch in iter_batches(rows, batch_size, self.max_params, self.max_packet):
+            result.extend(await self._insert_batch(batch))
+        return result
+
+    async def upsert(self, rows, key=None, update=None, batch_size=1000):
+        """
+            Inserts rows, updates existing ones on duplicate key
+            update - columns to update, all columns except key by default
+        """
+        if isinstance(rows, dict):
+            rows = [rows]
+        key = key or await self.get_primary_key()
+        if not key:
+            raise ValueError('No primary key')
+        if not isinstance(key, (list, tuple)):
+            key = [key]
+
+        for batch in iter_batches(rows, batch_size, self.max_params, self.max_packet):
+            started = self._started()
+            sql, keys, values = self._insert_sql(batch)
+            if update is None:
+                columns = [k for k in keys if k not in key]
+            else:
+                columns = update
+            if not columns:
+                columns = key[:1]
+            sql += ' ON DUPLICATE KEY UPDATE ' + ', '.join('{0} = VALUES({0})'.format(quote_key(c)) for c in columns)
+            await self.try_execute(sql, tuple(values), 'upsert', started)()
+
+    def _insert_sql(self, batch):
+        keys = list(batch[0].keys())
+        values = []
+        for row in batch:
+            if len(row) != len(keys):
+                raise ValueError('All rows must have the same columns')
+            for key in keys:
+                values.append(row[key])
+
+        items = '({})'.format(', '.join([self.keyword] * len(keys)))
+        sql = 'INSERT INTO `{}` ({}) VALUES {}'.format(self.tablename, ', '.join(map(quote_key, keys)), ', '.join([items] * len(batch)))
+        return sql, keys, values
+
+    async def _insert_batch(self, batch):
+        started = self._started()
+        sql, keys, values = self._insert_sql(batch)
+        async with self.try_execute(sql, tuple(values), 'insert', started) as cursor:
+            assert cursor.rowcount == len(batch)
+            first = cursor.lastrowid
+
+        key = await self.get_primary_key()
+        if key in keys:
+            return [row[key] for row in batch]
+        if not first:
+            return [None] * len(batch)
+        # ids of a simple multi-row insert are consecutive
+        return list(range(first, first + len(batch)))
+
+    def _filter_shape(self, filter):
         if filter is None:
             return None, []
         elif isinstance(filter, dict):
             keys = []
             values = []
             for k, v in filter.items():
+                keys.append((k, v is None))
+                if v is not None:
+                    values.append(v)
+            return ('dict', tuple(keys)), values
+        elif isinstance(filter, (list, tuple)):
+            return ('raw', filter[0]), list(filter[1:])
+        elif isinstance(filter, (int, str, bytes)):
+            return ('pk',), [filter]
+        else:
+            raise NotImplementedError
+
+    async def _build_where(self, shape):
+        if shape is None:
+            return None
+        kind = shape[0]
+        if kind == 'dict':
+            keys = []
+            for k, is_null in shape[1]:
                 if '.' not in k:
                     k = self.tablename +  '.' + k
                 k = quote_key(k)
-                if v is None:
+                if is_null:
                     keys.append(k + ' is NULL')
                 else:
                     keys.append(k + '=' + self.keyword)
-                    values.append(v)
-            sql = ' AND '.join(keys)
-            return sql, values
-        elif isinstance(filter, (list, tuple)):
-            return filter[0], filter[1:]
-        elif isinstance(filter, (int, str, bytes)):
+            return ' AND '.join(keys)
+        elif kind == 'raw':
+            return shape[1]
+        else:
             # find by primary key
-            key = None
-            for column in await self.describe():
-                if column['primary']:
-                    key = column['name']
-                    break
-            else:
+            key = await self.get_primary_key()
+            if not key:
                 raise ValueError('No primary key')
-            return '`{}` = {}'.format(key, self.keyword), [filter]
-        else:
-            raise NotImplementedError
+            return '`{}` = {}'.format(key, self.keyword)
+
+    async def _build_filter(self, filter):
+        shape, values = self._filter_shape(filter)
+        return await self._build_where(shape), values
+
+    async def _compiled(self, key, build, *a):
+        cache = self.engine.sql_cache
+        result = cache.get(key)
+        if result is None:
+            result = await build(*a)
+            cache.set(key, result)
+        return result
 
-    async def find_one(self, filter=None, join=None, left_join=None, for_update=False, columns=None, order_by=None):
-        result = list(await self.find(filter, limit=1, join=join, for_update=for_update, columns=columns, order_by=order_by))
+    async def find_one(self, filter=None, join=None, left_join=None, for_update=False, columns=None, order_by=None, row_type=dict):
+        result = list(await self.find(filter, limit=1, join=join, left_join=left_join, for_update=for_update, columns=columns, order_by=order_by, row_type=row_type))
         if result:
             return result[0]
 
-    async def find(self, filter=None, limit=None, join=None, left_join=None, for_update=False, columns=None, group_by=None, order_by=None):
+    async def find(self, filter=None, limit=None, join=None, left_join=None, for_update=False, columns=None, group_by=None, order_by=None, row_type=dict):
         """
             join='subtable.id=column'
             join='subtable as tbl.id=column'
+            row_type: dict, tuple, collections.namedtuple or sqlmapper.Row
+        """
+        started = self._started()
+        shape, values = self._filter_shape(filter)
+        key = ('find', self.tablename, shape, freeze(columns), join, left_join, for_update, group_by, freeze(order_by), limit)
+        sql, joins = await self._compiled(key, self._compile_find, shape, limit, join, left_join, for_update, columns, group_by, order_by)
+
+        result = []
+        execute = self.try_execute(sql, tuple(values), 'find', started)
+        async with execute as cursor:
+            if cursor.rowcount:
+                result = list(await cursor.fetchall())
+                start = execute.event and clock()
+                decode = make_decoder(cursor.description, joins, row_type)
+                if decode:
+                    result = list(map(decode, result))
+                if execute.event:
+                    execute.event.decode_time = clock() - start
+
+        return result
+
+    def iterate(self, filter=None, limit=None, join=None, left_join=None, for_update=False, columns=None, group_by=None, order_by=None, fetch_size=1000, row_type=dict):
+        """
+            async with db.tbl.iterate(...) as rows:
+                async for row in rows:
+                    ...
+
+            Rows are read from an unbuffered cursor by fetch_size, the cursor is closed at the end of rows
+            or on exit of the block. Without the block an iterator left by break has to be closed by await rows.aclose().
+            The connection (a single one, or of a transaction) can't run other queries while the rows are read,
+            RuntimeError is raised for them.
         """
+        return RowIterator(self._iterate(filter, limit, join, left_join, for_update, columns, group_by, order_by, fetch_size, row_type))
+
+    async def _iterate(self, filter, limit, join, left_join, for_update, columns, group_by, order_by, fetch_size, row_type):
+        started = self._started()
+        shape, values = self._filter_shape(filter)
+        key = ('find', self.tablename, shape, freeze(columns), join, left_join, for_update, group_by, freeze(order_by), limit)
+        sql, joins = await self._compiled(key, self._compile_find, shape, limit, join, left_join, for_update, columns, group_by, order_by)
+
+        engine = self.engine
+        event = engine.new_event(sql, values, self.tablename, 'find', started)
+        cursor = await engine.stream_cursor()
+        try:
+            start = event and clock()
+            try:
+                await cursor.execute(sql, tuple(values))
+            except Exception as e:
+                if event:
+                    event.error = e
+                raise
+            finally:
+                if event:
+                    event.db_time += clock() - start
+            decode = make_decoder(cursor.description, joins, row_type)
+            while True:
+                start = event and clock()
+                rows = await cursor.fetchmany(fetch_size)
+                if event:
+                    fetched = clock()
+                    event.db_time += fetched - start
+                if not rows:
+                    break
+                if event:
+                    if decode:
+                        rows = list(map(decode, rows))
+                    event.decode_time += clock() - fetched
+                    event.rows += len(rows)
+                elif decode:
+                    rows = map(decode, rows)
+                for row in rows:
+                    yield row
+        finally:
+            await cursor.close()
+            engine.release_cursor(cursor)
+            if event:
+                engine.emit(event)
 
+    async def _compile_find(self, shape, limit, join, left_join, for_update, columns, group_by, order_by):
         if columns:
             assert not join
             if not isinstance(columns, (list, tuple)):
@@ -304,10 +775,7 @@ class Table:
 
             key = None
             if left_join:
-                for c in self.engine.get_columns(self.tablename):
-                    if c['primary']:
-                        key = c['name']
-                        break
+                key = await self.get_primary_key()
 
             joins.append({
                 'alias': alias,
@@ -315,7 +783,7 @@ class Table:
             })
 
         sql = 'SELECT {} FROM `{}`'.format(columns, self.tablename)
-        where, values = await self._build_filter(filter)
+        where = await self._build_where(shape)
         if join:
             sql += join
         if where:
@@ -337,68 +805,59 @@ class Table:
             sql += ' LIMIT {}'.format(limit)
 
         if for_update:
-            sql += ' FOR UPDATE'
-
-        result = []
-        async with self.try_execute(sql, tuple(values)) as cursor:
-            if cursor.rowcount:
-                columns = cursor.description
-                for row in await cursor.fetchall():
-                    join_index = -1
-                    join_alias = None
-                    join_key = None
-                    d = {}
-                    for i, value in enumerate(row):
-                        col = columns[i]
-                        column_name = col[0]
-                        if column_name == '__divider':
-                            join_index += 1
-                            join_alias = joins[join_index]['alias']
-                            join_key = joins[join_index]['key']
-                            d[join_alias] = {}
-                            continue
-                        if join_alias:
-                            if column_name == join_key:
-                                if value is None:
-                                    d[join_alias] = None
-                            if d[join_alias] is not None:
-                                d[join_alias][column_name] = value
-                        else:
-                            d[column_name] = value
-                    result.append(d)
-
-        return result
+            try:
+                sql += lock_modes[for_update]
+            except KeyError:
+                raise ValueError('Wrong for_update: {}'.format(for_update))
+        return sql, joins
 
-    async def update(self, filter=None, update=None, limit=None):
+    async def update(self, filter=None, update=None, limit=None, inc=None):
+        """
+            inc={'value': 1} - SET value = value + 1
+        """
+        assert update or inc
+        started = self._started()
+        shape, values = self._filter_shape(filter)
+        keys = tuple(update.keys()) if update else ()
+        inc_keys = tuple(inc.keys()) if inc else ()
+        sql = await self._compiled(('update', self.tablename, keys, inc_keys, shape, limit), self._compile_update, keys, inc_keys, shape, limit)
+        values = [update[k] for k in keys] + [inc[k] for k in inc_keys] + values
+        await self.try_execute(sql, tuple(values), 'update', started)()
+
+    async def _compile_update(self, keys, inc_keys, shape, limit):
         up = []
-        values = []
-        for key, value in update.items():
+        for key in keys:
             up.append('`{}` = {}'.format(key, self.keyword))
-            values.append(value)
+        for key in inc_keys:
+            up.append('`{0}` = `{0}` + {1}'.format(key, self.keyword))
 
         sql = 'UPDATE `{}` SET {}'.format(self.tablename, ', '.join(up))
 
-        where, wvalues = await self._build_filter(filter)
+        where = await self._build_where(shape)
         if where:
             sql += ' WHERE ' + where
-            values += wvalues
 
         if limit:
             assert isinstance(limit, int)
             sql += ' LIMIT {}'.format(limit)
-
-        await self.try_execute(sql, tuple(values))()
+        return sql
 
     async def update_one(self, filter=None, update=None):
         await self.update(filter, update, limit=1)
 
     async def delete(self, filter=None):
-        where, values = await self._build_filter(filter)
+        started = self._started()
+        shape, values = self._filter_shape(filter)
+        sql = await self._compiled(('delete', self.tablename, shape), self._compile_delete, shape)
+        await self.try_execute(sql, tuple(values), 'delete', started)()
+
+    async def _compile_delete(self, shape):
+        where = await self._build_where(shape)
 
         sql = 'DELETE FROM `{}`'.format(self.tablename)
         if where:
             sql += ' WHERE {}'.format(where)
-        await self.try_execute(sql, tuple(values))()
+        return sql
 
     async def create_index(self, name, column, primary=False, unique=False, fulltext=False, exist_ok=False):
         if primary:
@@ -426,27 +885,35 @@ class Table:
             index_type = 'FULLTEXT '
 
         sql = 'ALTER TABLE `{}` ADD {}{}({})'.format(self.tablename, index_type, name, column)
-        await self.try_execute(sql)()
+        await self.try_execute(sql, operation='ddl')()
+        self.engine.refresh_schema(self.tablename)
 
     async def has_index(self, name):
-        async with self.try_execute('show index from ' + self.tablename) as cursor:
+        async with self.try_execute('show index from ' + self.tablename, operation='schema') as cursor:
             for row in await cursor.fetchall():
                 if row[2] == name:
                     return True
             return False
 
     async def count(self, filter=None):
-        where, values = await self._build_filter(filter)
+        started = self._started()
+        shape, values = self._filter_shape(filter)
+        sql = await self._compiled(('count', self.tablename, shape), self._compile_count, shape)
+        async with self.try_execute(sql, tuple(values), 'count', started) as cursor:
+            return (await cursor.fetchone())[0]
+
+    async def _compile_count(self, shape):
+        where = await self._build_where(shape)
 
         sql = 'SELECT COUNT(*) FROM `{}`'.format(self.tablename)
         if where:
             sql += ' WHERE {}'.format(where)
-        async with self.try_execute(sql, tuple(values)) as cursor:
-            return (await cursor.fetchone())[0]
+        return sql
 
     async def drop(self, exist_ok=True):
         sql = 'DROP TABLE '
         if exist_ok:
             sql += 'IF EXISTS '
         sql += self.tablename
-        await self.try_execute(sql)()
+        await self.try_execute(sql, operation='ddl')()
+        self.engine.refresh_schema(self.tablename)
@@ -1,3 +1,13 @@
+from __future__ import absolute_import
+import threading
+import functools
+from .utils import LRUCache, monotonic
+from .pool import Pool, CursorPool, close as close_quietly
+from .schema import SchemaCache
+from .replica import Replica, ReplicaSet, host_options
+from .instrument import QueryEvent, clock, emit
+
+
 
 class MultiException(Exception):
     def __init__(self, e):
@@ -6,15 +16,371 @@ class MultiException(Exception):
 
 
 class BaseEngine(object):
+    sql_cache_size = 512
+    cursor_pool_size = 4
+    pool = None
+    replicas = None
+    replica_lag = 1.0
+    result_cache = None
+    identity_map = False
+    listeners = ()
+    explain_prefix = 'EXPLAIN '
+    explain_rollback = True
+
     def __init__(self):
         if not hasattr(self, 'local'):
             self.local = type('local', (object,), {})()
+        self.sql_cache = LRUCache(self.sql_cache_size)
+        self.schema_cache = SchemaCache()
+        self.table_objects = {}
+        self.side_conn = None
+        self.side_lock = threading.Lock()
+        self.thread_init()
+
+    def add_listener(self, fn):
+        # fn(QueryEvent) is called after every statement
+        self.listeners = list(self.listeners) + [fn]
+
+    def remove_listener(self, fn):
+        self.listeners = [l for l in self.listeners if l is not fn]
+
+    def execute(self, cursor, sql, values=None, table=None, operation=None, started=None, emit_event=True):
+        """
+            Executes a statement, with listeners a QueryEvent is emitted (rows = rowcount)
+            or returned if emit_event=False, to be completed by a reader of the result
+            started - clock() before the sql was built
+        """
+        if not self.listeners:
+            if self.replicas is None:
+                self.send(cursor, sql, values)
+            else:
+                self.replicas.execute(self.send, cursor, sql, values)
+            return None
+
+        event = QueryEvent(sql, values, table, operation)
+        start = clock()
+        if started is not None:
+            event.build_time = start - started
+        try:
+            if self.replicas is None:
+                self.send(cursor, sql, values)
+            else:
+                self.replicas.execute(self.send, cursor, sql, values)
+        except Exception as e:
+            event.db_time = clock() - start
+            event.error = e
+            emit(self.listeners, event)
+            raise
+        event.db_time = clock() - start
+        if emit_event:
+            event.rows = cursor.rowcount
+            emit(self.listeners, event)
+        return event
+
+    def send(self, cursor, sql, values=None):
+        # an engine can send a statement in another way (prepared)
+        if values is None:
+            cursor.execute(sql)
+        else:
+            cursor.execute(sql, values)
+
+    def emit(self, event):
+        emit(self.listeners, event)
+
+    def get_side_connection(self):
+        return self.get_connection()
+
+    def explain(self, sql, values=None):
+        """
+            Returns a plan of a statement as a list of dicts,
+            it's run on a side connection, a transaction of the thread isn't touched
+        """
+        with self.side_lock:
+            if self.side_conn is None:
+                self.side_conn = self.get_side_connection()
+            conn = self.side_conn
+            try:
+                cursor = conn.cursor()
+                try:
+                    if values is None:
+                        cursor.execute(self.explain_prefix + sql)
+                    else:
+                        cursor.execute(self.explain_prefix + sql, values)
+                    names = [c[0] for c in cursor.description]
+                    rows = cursor.fetchall()
+                finally:
+                    close_quietly(cursor)
+                if self.explain_rollback:
+                    conn.rollback()
+            except Exception:
+                self.close_side_connection()
+                raise
+        return [dict(zip(names, row)) for row in rows]
+
+    def close_side_connection(self):
+        conn = self.side_conn
+        self.side_conn = None
+        if conn is not None:
+            close_quietly(conn)
+
+    def get_table(self, name):
+        table = self.table_objects.get(name)
+        if table is None:
+            table = self.table_objects[name] = self.create_table(name)
+        return table
+
+    def create_table(self, name):
+        raise NotImplementedError
+
+    def get_connection(self):
+        raise NotImplementedError
+
+    def load_columns(self, table):
+        raise NotImplementedError
+
+    def get_schema(self, table):
+        schema = self.schema_cache.get(table)
+        if schema is None:
+            schema = self.schema_cache.set(table, self.load_columns(table))
+        return schema
+
+    def get_columns(self, table):
+        return self.get_schema(table).columns
+
+    def refresh_schema(self, table=None):
+        self.schema_cache.invalidate(table)
+        self.sql_cache.clear()
+        if self.result_cache is not None:
+            if table is None:
+                self.result_cache.clear()
+            else:
+                self.result_cache.invalidate([table])
+        identity = getattr(self.local, 'identity', None)
+        if identity:
+            identity.clear()
+
+    def touch_table(self, table):
+        # tables written by the transaction of the thread, their cached results are dropped on commit
+        touched = getattr(self.local, 'touched', None)
+        if touched is None:
+            touched = self.local.touched = set()
+
+            def done(committed):
+                self.local.touched = None
+                if committed and self.result_cache is not None:
+                    self.result_cache.invalidate(touched)
+
+            self.on_commit(lambda: done(True))
+            self.on_rollback(lambda: done(False))
+        touched.add(table)
+
+    def get_identity_map(self):
+        # rows loaded by primary key in the transaction of the thread, (table, key) -> row or None
+        identity = getattr(self.local, 'identity', None)
+        if identity is None:
+            identity = self.local.identity = {}
+
+            def done():
+                self.local.identity = None
+
+            self.on_commit(done)
+            self.on_rollback(done)
+        return identity
+
+    def is_touched(self, tables):
+        touched = getattr(self.local, 'touched', None)
+        return bool(touched) and any(t in touched for t in tables)
+
+    def ping_connection(self, conn):
+        raise NotImplementedError
+
+    def init_pool(self, connect, kw):
+        """
+            pool_size, pool_min_idle, pool_idle_timeout, pool_max_lifetime, pool_pre_ping, pool_timeout
+        """
+        if not kw.get('pool_size'):
+            return
+        self.pool = Pool(
+            connect,
+            max_size=kw['pool_size'],
+            min_idle=kw.get('pool_min_idle', 0),
+            idle_timeout=kw.get('pool_idle_timeout'),
+            max_lifetime=kw.get('pool_max_lifetime'),
+            ping=self.ping_connection if kw.get('pool_pre_ping', True) else None,
+            timeout=kw.get('pool_timeout')
+        )
+
+    def get_replica_connection(self, config):
+        raise NotImplementedError
+
+    def init_replicas(self, replicas, kw):
+        """
+            replicas - list of hosts ('host', 'host:port') or dicts of connection options
+            replica_select - 'round_robin' or 'latency'
+            replica_lag - seconds a thread reads from the primary after its commit
+            pool_* options are applied to a pool of every replica
+        """
+        if not replicas:
+            return
+        items = []
+        for options in replicas:
+            options = host_options(options)
+            config = dict(self.db_config, **options)
+            pool = Pool(
+                functools.partial(self.get_replica_connection, config),
+                max_size=kw.get('pool_size') or 10,
+                idle_timeout=kw.get('pool_idle_timeout'),
+                max_lifetime=kw.get('pool_max_lifetime'),
+                ping=self.ping_connection if kw.get('pool_pre_ping', True) else None,
+                timeout=kw.get('pool_timeout')
+            )
+            items.append(Replica(options.get('host'), pool))
+        self.replicas = ReplicaSet(items, select=kw.get('replica_select', 'round_robin'))
+        self.replica_lag = kw.get('replica_lag', self.replica_lag)
+
+    def read_from_replica(self):
+        # reads of a transaction with writes, and for a lag window after its commit, go to the primary
+        if self.replicas is None:
+            return False
+        local = self.local
+        if getattr(local, 'wrote', False) or getattr(local, 'contextlvl', 0):
+            return False
+        return monotonic() >= getattr(local, 'sticky_until', 0)
+
+    def in_transaction(self):
+        # reads of the thread are run in its transaction on the primary
+        return not self.read_from_replica()
+
+    def end_writes(self, committed):
+        if getattr(self.local, 'wrote', False):
+            self.local.wrote = False
+            if committed:
+                self.local.sticky_until = monotonic() + self.replica_lag
+
+    def start_writes(self):
+        # the thread reads from the primary till the end of the transaction
+        self.local.wrote = True
+
+    def end_read(self):
+        # a transaction with reads only (out of "with db:") is committed, a next read takes a new snapshot
+        if getattr(self.local, 'wrote', False) or getattr(self.local, 'contextlvl', 0):
+            return
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.commit()
+            self.release_conn()
+        identity = getattr(self.local, 'identity', None)
+        if identity:
+            identity.clear()
+
+    def get_write_cursor(self):
+        self.start_writes()
+        return self.get_cursor()
+
+    def acquire_cursor(self, read=False):
+        # an own cursor for a result set, nested queries don't replace it
+        if read and self.read_from_replica():
+            cursor = self.replicas.acquire()
+            if cursor is not None:
+                return cursor
         self.thread_init()
+        conn = self.get_conn()
+        pools = getattr(self.local, 'cursors', None)
+        if pools is None:
+            pools = self.local.cursors = {}
+        pool = pools.get(id(conn))
+        if pool is None or pool.conn is not conn:
+            pool = pools[id(conn)] = CursorPool(conn, self.cursor_pool_size)
+        return pool.acquire()
+
+    def release_cursor(self, cursor):
+        if self.replicas is not None and self.replicas.release(cursor):
+            return
+        pools = getattr(self.local, 'cursors', None)
+        if pools:
+            for pool in pools.values():
+                if pool.release(cursor):
+                    return
+        # the connection is gone or the cursor is released by another thread
+        close_quietly(cursor)
+
+    def close_cursors(self, conn=None):
+        pools = getattr(self.local, 'cursors', None)
+        if not pools:
+            return
+        if conn is None:
+            self.local.cursors = None
+            for pool in pools.values():
+                pool.close()
+        else:
+            pool = pools.pop(id(conn), None)
+            if pool is not None:
+                pool.close()
+
+    def get_conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            if self.pool:
+                conn = self.pool.acquire()
+            else:
+                conn = self.get_connection()
+            self.local.conn = conn
+        return conn
+
+    def release_conn(self, discard=False):
+        # a connection of the pool is held by the thread till the end of transaction
+        if not self.pool:
+            return
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            return
+        self.local.conn = None
+        self.local.cursor = None
+        self.close_cursors(conn)
+        self.pool.release(conn, discard=discard)
+
+    def commit(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.commit()
+            self.release_conn()
+        identity = getattr(self.local, 'identity', None)
+        if identity:
+            identity.clear()
+        self.end_writes(True)
+        self.fire_event(True)
+
+    def rollback(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            try:
+                conn.rollback()
+            except Exception:
+                self.end_writes(False)
+                self.release_conn(discard=True)
+                raise
+            self.release_conn()
+        self.end_writes(False)
+        self.fire_event(False)
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if self.replicas is not None:
+            self.replicas.close()
+        self.close_side_connection()
+        self.close_cursors()
+        self.local.cursor = None
+        self.local.conn = None
+        if self.pool:
+            if conn is not None:
+                self.pool.release(conn, discard=True)
+            self.pool.close()
+        elif conn is not None:
+            conn.close()
 
     def thread_init(self):
-        if hasattr(self.local, 'tables'):
+        if hasattr(self.local, 'commit'):
             return
-        self.local.tables = {}
         self.local.commit = []
         self.local.rollback = []
 
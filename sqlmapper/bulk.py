@@ -0,0 +1,112 @@
+from __future__ import absolute_import
+import binascii
+import itertools
+from .utils import NoValue, is_str, is_bytes
+
+
+escapes = ((b'\\', b'\\\\'), (b'\t', b'\\t'), (b'\n', b'\\n'), (b'\r', b'\\r'), (b'\x00', b'\\0'))
+
+
+def escape(data):
+    for char, replacement in escapes:
+        if char in data:
+            data = data.replace(char, replacement)
+    return data
+
+
+def text(value):
+    if not is_str(value):
+        value = u'{}'.format(value)
+    return value.encode('utf8')
+
+
+def copy_value(value):
+    # a field of COPY text format (PostgreSQL)
+    if value is None:
+        return b'\\N'
+    if value is True:
+        return b't'
+    if value is False:
+        return b'f'
+    if is_bytes(value):
+        # bytea hex input, its backslash is escaped
+        return b'\\\\x' + binascii.hexlify(value)
+    return escape(text(value))
+
+
+def infile_value(value):
+    # a field of LOAD DATA with default FIELDS/LINES options (MySQL)
+    if value is None:
+        return b'\\N'
+    if value is True:
+        return b'1'
+    if value is False:
+        return b'0'
+    if is_bytes(value):
+        return escape(value)
+    return escape(text(value))
+
+
+def row_encoder(format_value):
+    # tab separated fields, a line per row
+    def encode(row):
+        return b'\t'.join([format_value(value) for value in row]) + b'\n'
+    return encode
+
+
+def bulk_rows(rows, columns=None):
+    """
+        Returns columns and an iterator of tuples (None for no rows),
+        rows are dicts or sequences in order of columns
+    """
+    rows = iter(rows)
+    first = next(rows, NoValue)
+    if first is NoValue:
+        return columns, None
+    rows = itertools.chain([first], rows)
+    if isinstance(first, dict):
+        if columns is None:
+            columns = list(first.keys())
+        return columns, (tuple([row[c] for c in columns]) for row in rows)
+    if not columns:
+        raise ValueError('No columns')
+    return columns, rows
+
+
+def iter_slices(rows, size):
+    # lazy chunks of an iterator, a chunk has to be read before the next one
+    while True:
+        first = next(rows, NoValue)
+        if first is NoValue:
+            return
+        yield itertools.chain([first], itertools.islice(rows, size - 1))
+
+
+class RowStream(object):
+    """
+        File-like object for COPY FROM STDIN, rows are encoded by read(size),
+        so not more than one read is kept in memory
+    """
+    def __init__(self, rows, encode):
+        self.rows = rows
+        self.encode = encode
+        self.buffer = b''
+        self.count = 0
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            row = next(self.rows, NoValue)
+            if row is NoValue:
+                break
+            line = self.encode(row)
+            chunks.append(line)
+            length += len(line)
+            self.count += 1
+        data = b''.join(chunks)
+        if size < 0 or length <= size:
+            self.buffer = b''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
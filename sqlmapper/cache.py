@@ -0,0 +1,108 @@
+from __future__ import absolute_import
+import threading
+from collections import OrderedDict
+from .utils import monotonic, value_size
+
+
+def result_size(value):
+    # estimation of memory taken by a cached result
+    if isinstance(value, (list, tuple)):
+        return 64 + sum(result_size(v) for v in value)
+    if value is None:
+        return 16
+    return value_size(value) + 32
+
+
+class MemoryCache(object):
+    """
+        In-process cache of query results with LRU and TTL eviction, entries are tagged by tables
+        max_entries - max number of results
+        max_bytes - memory budget, estimated by sizes of values
+        ttl - seconds, default time to live
+
+        A shared backend has to implement the same methods:
+            version(tags) -> token, get(key) -> value or None,
+            set(key, value, tags, ttl, version), invalidate(tags), clear()
+        set() has to drop a value if a tag was invalidated (or the cache was cleared) after version() was taken,
+        so a result read before a commit isn't cached after it.
+
+        Only writes of Table methods invalidate results, writes by raw db.cursor don't,
+        refresh_schema(table) or result_cache.invalidate([table]) has to be called after them.
+    """
+    def __init__(self, max_entries=10000, max_bytes=64 << 20, ttl=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.data = OrderedDict()  # key -> (value, tags, expires, size)
+        self.tags = {}  # tag -> set of keys
+        self.versions = {}  # tag -> number of invalidations
+        self.generation = 0  # number of clear()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def version(self, tags):
+        with self.lock:
+            return self._version(tags)
+
+    def _version(self, tags):
+        return (self.generation,) + tuple(self.versions.get(tag, 0) for tag in tags)
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None:
+                if item[2] > monotonic():
+                    # the most recently used key is the last one
+                    del self.data[key]
+                    self.data[key] = item
+                    self.hits += 1
+                    return item[0]
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def set(self, key, value, tags, ttl=None, version=None):
+        size = result_size(value)
+        if size > self.max_bytes:
+            return
+        expires = monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            if version is not None and version != self._version(tags):
+                return
+            if key in self.data:
+                self._remove(key)
+            self.data[key] = (value, tags, expires, size)
+            self.size += size
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while self.data and (len(self.data) > self.max_entries or self.size > self.max_bytes):
+                self._remove(next(iter(self.data)))
+
+    def _remove(self, key):
+        value, tags, expires, size = self.data.pop(key)
+        self.size -= size
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def invalidate(self, tags):
+        with self.lock:
+            for tag in tags:
+                self.versions[tag] = self.versions.get(tag, 0) + 1
+                for key in list(self.tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.data.clear()
+            self.tags.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.data)
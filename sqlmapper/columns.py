@@ -0,0 +1,94 @@
+from __future__ import absolute_import
+import array
+from decimal import Decimal
+from .utils import is_int
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def get_typecode(values):
+    typecode = 'q'
+    for value in values:
+        if isinstance(value, bool) or not (is_int(value) or isinstance(value, (float, Decimal))):
+            return None
+        if not is_int(value):
+            typecode = 'd'
+    return typecode
+
+
+class ColumnBuilder(object):
+    def __init__(self):
+        self.data = None
+
+    def extend(self, values):
+        # every batch is checked, an array would coerce a value of another type (True -> 1)
+        typecode = get_typecode(values)
+        if self.data is None:
+            self.data = array.array(typecode) if typecode else []
+        elif isinstance(self.data, array.array) and typecode != self.data.typecode:
+            if typecode == 'd':
+                self.data = array.array('d', self.data)
+            elif typecode is None:
+                self.data = list(self.data)
+
+        if isinstance(self.data, list):
+            self.data.extend(values)
+            return
+
+        size = len(self.data)
+        try:
+            self.data.extend(values)
+        except (TypeError, OverflowError):
+            # a partial batch can be appended before an error
+            del self.data[size:]
+            self.data = list(self.data)
+            self.data.extend(values)
+
+    def result(self, use_numpy):
+        data = self.data
+        if data is None:
+            data = array.array('q')
+        if not use_numpy:
+            return data
+        if isinstance(data, list):
+            result = numpy.empty(len(data), dtype=object)
+            result[:] = data
+            return result
+        dtype = 'int64' if data.typecode == 'q' else 'float64'
+        if not data:
+            return numpy.zeros(0, dtype=dtype)
+        return numpy.frombuffer(data, dtype=dtype)
+
+
+def read_columns(cursor, fetch_size, as_columns=True):
+    """
+        Reads a result set to a dict column -> array.array (or numpy array),
+        rows are transposed by batches of fetch_size, non-numeric columns are stored in lists
+        as_columns: True - numpy if installed, 'numpy', 'array'
+    """
+    if as_columns == 'numpy':
+        if numpy is None:
+            raise ImportError('numpy is not installed')
+        use_numpy = True
+    elif as_columns == 'array':
+        use_numpy = False
+    else:
+        use_numpy = numpy is not None
+
+    builders = None
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            break
+        if builders is None:
+            builders = [ColumnBuilder() for _ in cursor.description]
+        for builder, values in zip(builders, zip(*rows)):
+            builder.extend(values)
+
+    names = [col[0] for col in cursor.description or ()]
+    if builders is None:
+        builders = [ColumnBuilder() for _ in names]
+    return dict((name, builder.result(use_numpy)) for name, builder in zip(names, builders))
@@ -2,6 +2,8 @@
 class Connection(object):
     def __init__(self, **kw):
         engine = kw.pop('engine', None) or 'mysql'
+        result_cache = kw.pop('result_cache', None)
+        identity_map = kw.pop('identity_map', False)
 
         if engine == 'mysql':
             from .mysql import Engine as engine
@@ -12,6 +14,8 @@ class Connection(object):
         elif not callable(engine):
             raise NotImplementedError
         self._engine = engine(**kw)
+        self._engine.result_cache = result_cache
+        self._engine.identity_map = identity_map
         self._engine.local.contextlvl = 0
 
     def commit(self):
@@ -38,6 +42,12 @@ class Connection(object):
     def on_rollback(self, fn):
         self._engine.on_rollback(fn)
 
+    def add_listener(self, fn):
+        self._engine.add_listener(fn)
+
+    def remove_listener(self, fn):
+        self._engine.remove_listener(fn)
+
     def __enter__(self):
         self._engine.local.contextlvl += 1
 
@@ -53,4 +63,5 @@ class Connection(object):
 
     @property
     def cursor(self):
-        return self._engine.get_cursor()
+        # raw statements can write, so it's a cursor of the write transaction (the primary, the SQLite writer)
+        return self._engine.get_write_cursor()
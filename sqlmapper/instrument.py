@@ -0,0 +1,336 @@
+from __future__ import absolute_import
+import re
+import time
+import logging
+import threading
+from collections import deque
+from .utils import LRUCache
+
+clock = getattr(time, 'perf_counter', time.time)
+log = logging.getLogger('sqlmapper')
+
+
+re_values = re.compile(r'(\((?:\s*(?:%s|\?)\s*,?)+\))(?:\s*,\s*\((?:\s*(?:%s|\?)\s*,?)+\))+')
+re_in = re.compile(r'\bIN\s*\((?:\s*(?:%s|\?)\s*,?)+\)', re.I)
+re_number = re.compile(r'(?<![\w`"$.])\d+(?:\.\d+)?\b')
+re_string = re.compile(r"'(?:[^']|'')*'")
+re_space = re.compile(r'\s+')
+fingerprints = LRUCache(2048)
+
+
+def fingerprint(sql):
+    """
+        Normalised query: literals are replaced by ?, lists of placeholders and multi-row VALUES are collapsed,
+        so queries which differ by a number of values have one fingerprint
+    """
+    result = fingerprints.get(sql)
+    if result is None:
+        result = re_string.sub('?', sql)
+        result = re_number.sub('?', result)
+        result = re_in.sub('IN (...)', result)
+        result = re_values.sub(r'\1, ...', result)
+        result = re_space.sub(' ', result).strip()
+        fingerprints.set(sql, result)
+    return result
+
+
+class QueryEvent(object):
+    """
+        One executed statement, times are in seconds
+        build_time - building of sql, db_time - execute and fetch, decode_time - decoding of rows
+    """
+    __slots__ = ('sql', 'values', 'table', 'operation', 'params', 'rows', 'build_time', 'db_time', 'decode_time', 'error')
+
+    def __init__(self, sql, values=None, table=None, operation=None):
+        self.sql = sql
+        self.values = values
+        self.table = table
+        self.operation = operation
+        self.params = len(values) if values else 0
+        self.rows = 0
+        self.build_time = 0.0
+        self.db_time = 0.0
+        self.decode_time = 0.0
+        self.error = None
+
+    @property
+    def fingerprint(self):
+        return fingerprint(self.sql)
+
+    @property
+    def total_time(self):
+        return self.build_time + self.db_time + self.decode_time
+
+    def __repr__(self):
+        return '<QueryEvent {} {} {:.6f}s>'.format(self.operation, self.table, self.total_time)
+
+
+def emit(listeners, event):
+    # a broken listener doesn't break a query
+    for fn in listeners:
+        try:
+            fn(event)
+        except Exception:
+            log.exception('Query listener failed')
+
+
+class Histogram(object):
+    """
+        Log-linear histogram of integer values (HDR style): values below 2 ** (precision + 1) are exact,
+        bigger ones are kept with relative error below 2 ** -precision
+    """
+    def __init__(self, precision=5):
+        self.precision = precision
+        self.linear = 1 << (precision + 1)
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def index(self, value):
+        if value < self.linear:
+            return value
+        shift = value.bit_length() - self.precision - 1
+        return (shift << self.precision) + (value >> shift)
+
+    def upper(self, index):
+        # the highest value of a bucket
+        if index < self.linear:
+            return index
+        shift = (index >> self.precision) - 1
+        return ((index - (shift << self.precision) + 1) << shift) - 1
+
+    def record(self, value):
+        value = max(int(value), 0)
+        i = self.index(value)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        if not self.count:
+            return 0
+        rank = max(q * self.count / 100.0, 1)
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= rank:
+                return min(self.upper(i), self.max)
+        return self.max
+
+    def merge(self, other):
+        for i, n in other.counts.items():
+            self.counts[i] = self.counts.get(i, 0) + n
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+
+class QueryStats(object):
+    __slots__ = ('fingerprint', 'table', 'operation', 'calls', 'errors', 'rows', 'params', 'build_time', 'db_time', 'decode_time', 'latency')
+
+    def __init__(self, fingerprint, table, operation):
+        self.fingerprint = fingerprint
+        self.table = table
+        self.operation = operation
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.params = 0
+        self.build_time = 0.0
+        self.db_time = 0.0
+        self.decode_time = 0.0
+        self.latency = Histogram()  # microseconds
+
+    def add(self, event):
+        self.calls += 1
+        if event.error is not None:
+            self.errors += 1
+        if event.rows and event.rows > 0:
+            self.rows += event.rows
+        self.params += event.params
+        self.build_time += event.build_time
+        self.db_time += event.db_time
+        self.decode_time += event.decode_time
+        self.latency.record(event.total_time * 1e6)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Collector(object):
+    """
+        Listener which keeps latency histograms per query fingerprint
+
+        collector = Collector()
+        db.add_listener(collector)
+        collector.to_dict()
+        collector.to_prometheus()
+    """
+    percentiles = (50, 90, 99, 99.9)
+
+    def __init__(self, max_queries=1000):
+        self.max_queries = max_queries
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        key = event.fingerprint
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                if len(self.stats) >= self.max_queries:
+                    key = '<other>'
+                    stats = self.stats.get(key)
+                if stats is None:
+                    stats = self.stats[key] = QueryStats(key, event.table, event.operation)
+            stats.add(event)
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def to_dict(self):
+        result = {}
+        with self.lock:
+            for key, s in self.stats.items():
+                latency = s.latency
+                result[key] = {
+                    'table': s.table,
+                    'operation': s.operation,
+                    'calls': s.calls,
+                    'errors': s.errors,
+                    'rows': s.rows,
+                    'params': s.params,
+                    'build_time': s.build_time,
+                    'db_time': s.db_time,
+                    'decode_time': s.decode_time,
+                    'latency_us': dict(
+                        [('min', latency.min or 0), ('max', latency.max), ('mean', latency.total / latency.count if latency.count else 0)] +
+                        [('p{:g}'.format(q), latency.percentile(q)) for q in self.percentiles]
+                    )
+                }
+        return result
+
+    def to_prometheus(self, prefix='sqlmapper'):
+        lines = [
+            '# HELP {}_query_seconds Query latency by fingerprint'.format(prefix),
+            '# TYPE {}_query_seconds summary'.format(prefix)
+        ]
+        counters = []
+        with self.lock:
+            for s in self.stats.values():
+                labels = 'fingerprint="{}",table="{}",operation="{}"'.format(escape_label(s.fingerprint), escape_label(s.table or ''), escape_label(s.operation or ''))
+                for q in self.percentiles:
+                    lines.append('{}_query_seconds{{{},quantile="{:g}"}} {:.6f}'.format(prefix, labels, q / 100.0, s.latency.percentile(q) / 1e6))
+                lines.append('{}_query_seconds_sum{{{}}} {:.6f}'.format(prefix, labels, s.latency.total / 1e6))
+                lines.append('{}_query_seconds_count{{{}}} {}'.format(prefix, labels, s.calls))
+                counters.append((labels, s))
+
+        for name, help, attr in (('errors', 'Failed queries', 'errors'), ('rows', 'Rows returned or affected', 'rows')):
+            lines.append('# HELP {}_query_{}_total {}'.format(prefix, name, help))
+            lines.append('# TYPE {}_query_{}_total counter'.format(prefix, name))
+            for labels, s in counters:
+                lines.append('{}_query_{}_total{{{}}} {}'.format(prefix, name, labels, getattr(s, attr)))
+
+        lines.append('# HELP {}_query_phase_seconds_total Time by phase: build, db, decode'.format(prefix))
+        lines.append('# TYPE {}_query_phase_seconds_total counter'.format(prefix))
+        for labels, s in counters:
+            for phase in ('build', 'db', 'decode'):
+                lines.append('{}_query_phase_seconds_total{{{},phase="{}"}} {:.6f}'.format(prefix, labels, phase, getattr(s, phase + '_time')))
+        return '\n'.join(lines) + '\n'
+
+
+def param_shape(values):
+    # types of bound parameters, values aren't recorded
+    result = []
+    for value in values or ():
+        if isinstance(value, (list, tuple)):
+            result.append('{}[{}]'.format(type(value).__name__, len(value)))
+        else:
+            result.append(type(value).__name__)
+    return tuple(result)
+
+
+class SlowQueryLog(object):
+    """
+        Listener which records statements slower than threshold (seconds) with their plans
+
+        slow = SlowQueryLog(db, threshold=0.5)
+        db.add_listener(slow)
+        slow.records  # the last max_records records
+
+        A plan is taken by EXPLAIN on a side connection, not more than max_explains per interval (seconds)
+        and once per fingerprint per interval, so it doesn't add load to a slow database.
+        Every record is written to the 'sqlmapper.slow' logger and passed to on_record(record).
+    """
+    def __init__(self, db, threshold=1.0, operations=('find', 'update', 'delete', 'count'), max_explains=5, interval=60.0, max_records=100, on_record=None):
+        self.engine = getattr(db, '_engine', db)
+        self.threshold = threshold
+        self.operations = operations
+        self.max_explains = max_explains
+        self.interval = interval
+        self.on_record = on_record
+        self.records = deque(maxlen=max_records)
+        self.explained = LRUCache(1000)  # fingerprint -> time of the last explain
+        self.window = 0
+        self.explains = 0
+        self.lock = threading.Lock()
+        self.log = logging.getLogger('sqlmapper.slow')
+
+    def __call__(self, event):
+        if event.error is not None or event.total_time < self.threshold:
+            return
+        if self.operations and event.operation not in self.operations:
+            return
+
+        key = event.fingerprint
+        record = {
+            'fingerprint': key,
+            'sql': event.sql,
+            'table': event.table,
+            'operation': event.operation,
+            'params': param_shape(event.values),
+            'rows': event.rows,
+            'time': event.total_time,
+            'db_time': event.db_time,
+            'at': time.time(),
+            'plan': None
+        }
+        if self.allow_explain(key):
+            try:
+                record['plan'] = self.engine.explain(event.sql, event.values)
+            except Exception as e:
+                record['plan_error'] = str(e)
+
+        with self.lock:
+            self.records.append(record)
+        self.log.warning('Slow query %.3fs %s %s', record['time'], key, record['params'])
+        if self.on_record:
+            self.on_record(record)
+
+    def allow_explain(self, key):
+        if not self.max_explains or not hasattr(self.engine, 'explain'):
+            # aio engine has no sync side connection
+            return False
+        now = clock()
+        with self.lock:
+            if now - self.window >= self.interval:
+                self.window = now
+                self.explains = 0
+            if self.explains >= self.max_explains:
+                return False
+            last = self.explained.get(key)
+            if last is not None and now - last < self.interval:
+                return False
+            self.explains += 1
+            self.explained.set(key, now)
+            return True
@@ -1,30 +1,67 @@
 
 from __future__ import absolute_import
 import MySQLdb
+import MySQLdb.cursors
 import threading
+import functools
+import tempfile
+import shutil
+import os
 import re
-import copy
 from .table import Table
 from .utils import NoValue, validate_name
 from .base_engine import BaseEngine
+from .replica import host_options
+from .bulk import RowStream, bulk_rows, row_encoder, infile_value, iter_slices
+
+
+re_int = re.compile(r'(tiny|small|medium|big)?int', re.I)
+re_matched = re.compile(r'Rows matched: (\d+)')
 
 
 class Engine(BaseEngine):
-    def __init__(self, autocreate=None, read_commited=False, **kw):
+    auto_increment_increment = None
+
+    def __init__(self, autocreate=None, read_commited=False, primary=None, replicas=None, **kw):
+        """
+            primary - host of the primary ('host', 'host:port' or a dict of options), replicas - list of hosts,
+            reads out of a transaction are sent to replicas, see BaseEngine.init_replicas
+            Statements aren't prepared on the server (prepare_threshold of PostgreSQL),
+            MySQLdb has no API for server-side prepared statements, a statement is sent as text
+        """
         self.read_commited = read_commited
+        if primary:
+            kw.update(host_options(primary))
         self.local = threading.local()
         if 'charset' not in kw:
             kw['charset'] = 'utf8mb4'
         super(Engine, self).__init__()
 
         self.db_config = {}
-        for k in ['host', 'port', 'user', 'password', 'db', 'charset']:
+        for k in ['host', 'port', 'user', 'password', 'db', 'charset', 'local_infile']:
             if k in kw:
                 self.db_config[k] = kw[k]
 
-        self.local.conn = self.get_connection(autocreate_db=autocreate)
+        connect = functools.partial(self.get_connection, autocreate_db=autocreate)
+        self.init_pool(connect, kw)
+        if not self.pool:
+            self.local.conn = connect()
+        self.init_replicas(replicas, kw)
 
     def get_connection(self, autocreate_db=False):
+        conn = self.connect(autocreate_db)
+        if self.read_commited:
+            cursor = conn.cursor()
+            cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+            cursor.close()
+        return conn
+
+    def get_replica_connection(self, config):
+        conn = MySQLdb.connect(**config)
+        conn.autocommit(True)
+        return conn
+
+    def connect(self, autocreate_db=False):
         try:
             return MySQLdb.connect(**self.db_config)
         except MySQLdb.OperationalError as e:
@@ -40,63 +77,136 @@ class Engine(BaseEngine):
             else:
                 raise
 
-    def commit(self):
-        self.local.conn.commit()
-        self.fire_event(True)
-    
-    def rollback(self):
-        self.local.conn.rollback()
-        self.fire_event(False)
-
-    def close(self):
-        self.local.conn.close()
-        self.local.cursor = None
-        self.local.conn = None
+    def ping_connection(self, conn):
+        try:
+            conn.ping()
+            return True
+        except MySQLdb.Error:
+            return False
 
     def get_cursor(self):
         self.thread_init()
-        if hasattr(self.local, 'cursor'):
-            return self.local.cursor
-        
-        if not hasattr(self.local, 'conn'):
-            self.local.conn = self.get_connection()
+        cursor = getattr(self.local, 'cursor', None)
+        if cursor:
+            return cursor
 
-        self.local.cursor = cursor = self.local.conn.cursor()
-        if self.read_commited:
-            cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        self.local.cursor = cursor = self.get_conn().cursor()
         return cursor
 
-    def get_table(self, name):
+    def get_stream_cursor(self):
+        # unbuffered cursor, the result has to be read or closed before the next query on the connection
+        return self.get_conn().cursor(MySQLdb.cursors.SSCursor)
+
+    def create_table(self, name):
         return MysqlTable(name, self)
+
+    def get_auto_increment_increment(self, cursor):
+        # a step of ids (replication setups), it's read once
+        if self.auto_increment_increment is None:
+            self.execute(cursor, 'SELECT @@auto_increment_increment', operation='schema')
+            self.auto_increment_increment = int(cursor.fetchone()[0])
+        return self.auto_increment_increment
     
     def get_tables(self):
         cursor = self.get_cursor()
 
-        cursor.execute('SHOW TABLES')
+        self.execute(cursor, 'SHOW TABLES', operation='schema')
         for row in cursor:
             yield row[0]
 
-    def get_columns(self, table):
-        self.thread_init()
-        result = self.local.tables.get(table)
-        if not result:
-            result = []
-            cursor = self.get_cursor()
-            cursor.execute('describe `{}`'.format(table))
-            for row in cursor:
-                result.append({
-                    'name': row[0],
-                    'type': row[1],
-                    'null': row[2] == 'YES',
-                    'default': row[4],
-                    'primary': row[3] == 'PRI',
-                    'auto_increment': row[5] == 'auto_increment'
-                })
-            self.local.tables[table] = result
-        return copy.deepcopy(result)
+    def load_columns(self, table):
+        result = []
+        cursor = self.get_cursor()
+        self.execute(cursor, 'describe `{}`'.format(table), table=table, operation='schema')
+        for row in cursor:
+            result.append({
+                'name': row[0],
+                'type': row[1],
+                'null': row[2] == 'YES',
+                'default': row[4],
+                'primary': row[3] == 'PRI',
+                'auto_increment': row[5] == 'auto_increment'
+            })
+        return result
 
 
 class MysqlTable(Table):
+    bulk_chunk_size = 1000000
+
+    def bulk_load(self, rows, columns=None, chunk_size=None):
+        """
+            LOAD DATA LOCAL INFILE of temporary files of chunk_size rows, so disk usage is bounded,
+            needs Connection(local_infile=1) and local_infile=ON on the server
+        """
+        columns, rows = bulk_rows(rows, columns)
+        if rows is None:
+            return 0
+        sql = 'LOAD DATA LOCAL INFILE %s INTO TABLE {} CHARACTER SET utf8mb4 ({})'.format(self.cc(self.tablename), ', '.join(map(self.cc, columns)))
+        encode = row_encoder(infile_value)
+        cursor = self.write_cursor
+        count = 0
+        for chunk in iter_slices(rows, chunk_size or self.bulk_chunk_size):
+            started = self._started()
+            fd, path = tempfile.mkstemp(prefix='sqlmapper_', suffix='.tsv')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    shutil.copyfileobj(RowStream(chunk, encode), f, 1 << 16)
+                self._execute(cursor, 'bulk_load', sql, (path,), started)
+                count += cursor.rowcount
+            finally:
+                os.remove(path)
+        self._forget(missing=True)
+        return count
+
+    def _generated_ids(self, cursor, count):
+        # the first id of a multi-row insert, next ones are by @@auto_increment_increment
+        first = cursor.lastrowid
+        if not first:
+            return [None] * count
+        step = self.engine.get_auto_increment_increment(cursor) if count > 1 else 1
+        return list(range(first, first + count * step, step))
+
+    def _temp_key(self, column_type):
+        if re.search(r'text|blob', column_type, re.I):
+            # a key of TEXT/BLOB needs a length, a prefix isn't unique
+            return 'id {}, INDEX (id(255))'.format(column_type)
+        return 'id {} PRIMARY KEY'.format(column_type)
+
+    def increment(self, filter, column, value=1):
+        info = self.get_column(column)
+        if info and not re_int.match(info['type']):
+            # LAST_INSERT_ID keeps an integer
+            return self._increment_locked(filter, column, value)
+        return super(MysqlTable, self).increment(filter, column, value)
+
+    def _compile_increment(self, column, shape):
+        # LAST_INSERT_ID(expr) keeps the new value for the connection
+        sql = 'UPDATE {0} SET {1} = LAST_INSERT_ID({1} + %s)'.format(self.cc(self.tablename), self.cc(column))
+        where = self._build_where(shape)
+        if where:
+            sql += ' WHERE ' + where
+        return sql
+
+    def _increment_result(self, cursor, filter, column):
+        # rowcount is a number of changed rows, an unchanged row (value=0) is matched only
+        if not cursor.rowcount:
+            match = re_matched.search(cursor.connection.info() or '')
+            if not match or not int(match.group(1)):
+                return None
+        self._execute(cursor, 'increment', 'SELECT LAST_INSERT_ID()')
+        value = cursor.fetchone()[0]
+        info = self.get_column(column)
+        if value >= 1 << 63 and not (info and 'unsigned' in info['type'].lower()):
+            # LAST_INSERT_ID() is BIGINT UNSIGNED
+            value -= 1 << 64
+        return value
+
+    def _upsert_clause(self, key, columns):
+        if not columns:
+            # keeps an existing row as is
+            columns = key[:1]
+        return ' ON DUPLICATE KEY UPDATE ' + ', '.join('{0} = VALUES({0})'.format(self.cc(c)) for c in columns)
+
     def add_column(self, name, column_type, not_null=False, default=NoValue, exist_ok=False, primary=False, auto_increment=False, collate=None):
         validate_name(name)
         assert re.match(r'^[\w\d\(\),]+$', column_type), 'Wrong type: {}'.format(column_type)
@@ -134,12 +244,13 @@ class MysqlTable(Table):
             collate = collate or 'utf8mb4_unicode_ci'
             charset = collate.split('_')[0]
             sql = 'CREATE TABLE `{}` ({}) ENGINE=InnoDB DEFAULT CHARSET {} COLLATE {}'.format(self.tablename, scolumn, charset, collate)
-        self.cursor.execute(sql, tuple(values))
-        self.engine.local.tables[self.tablename] = None
+        self._execute(self.write_cursor, 'ddl', sql, tuple(values))
+        self.engine.refresh_schema(self.tablename)
 
     def has_index(self, name):
-        self.cursor.execute('show index from ' + self.tablename)
-        for row in self.cursor:
+        cursor = self.cursor
+        self._execute(cursor, 'schema', 'show index from ' + self.tablename)
+        for row in cursor:
             if row[2] == name:
                 return True
         return False
@@ -170,4 +281,5 @@ class MysqlTable(Table):
             index_type = 'FULLTEXT '
 
         sql = 'ALTER TABLE {} ADD {}{}({})'.format(self.cc(self.tablename), index_type, name, column)
-        self.cursor.execute(sql)
+        self._execute(self.write_cursor, 'ddl', sql)
+        self.engine.refresh_schema(self.tablename)
@@ -0,0 +1,181 @@
+from __future__ import absolute_import
+import threading
+from collections import deque
+from .utils import monotonic
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def close(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class Pool(object):
+    """
+        Bounded pool of connections
+        max_size - max number of open connections, acquire() waits for a free one
+        min_idle - number of idle connections to keep open
+        idle_timeout - seconds, idle connections are closed after it
+        max_lifetime - seconds, connections are closed after it
+        ping - fn(conn) -> bool, checks a connection before it's given out
+        timeout - seconds to wait for a connection, PoolTimeout is raised after it
+    """
+    def __init__(self, connect, max_size=10, min_idle=0, idle_timeout=None, max_lifetime=None, ping=None, timeout=None):
+        assert max_size > 0
+        assert min_idle <= max_size
+        self.connect = connect
+        self.max_size = max_size
+        self.min_idle = min_idle
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.ping = ping
+        self.timeout = timeout
+
+        self.idle = deque()  # (conn, created, released)
+        self.created = {}  # id(conn) -> created
+        self.size = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.fill()
+
+    def expired(self, created, released, now):
+        if self.max_lifetime is not None and now - created > self.max_lifetime:
+            return True
+        if self.idle_timeout is not None and now - released > self.idle_timeout:
+            return True
+        return False
+
+    def new_connection(self):
+        # a slot has to be reserved by size
+        try:
+            conn = self.connect()
+        except Exception:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+        with self.cond:
+            self.created[id(conn)] = monotonic()
+        return conn
+
+    def acquire(self):
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        while True:
+            conn = None
+            expired = []
+            with self.cond:
+                while True:
+                    if self.closed:
+                        raise PoolTimeout('Pool is closed')
+                    now = monotonic()
+                    while self.idle:
+                        c, created, released = self.idle.pop()
+                        if self.expired(created, released, now):
+                            self.forget(c)
+                            expired.append(c)
+                            continue
+                        conn = c
+                        break
+                    if conn is not None:
+                        break
+                    if self.size < self.max_size:
+                        self.size += 1
+                        break
+                    if deadline is None:
+                        self.cond.wait()
+                    else:
+                        left = deadline - now
+                        if left <= 0:
+                            raise PoolTimeout('No free connection in the pool')
+                        self.cond.wait(left)
+
+            for c in expired:
+                close(c)
+
+            if conn is None:
+                return self.new_connection()
+            if self.ping is None or self.ping(conn):
+                return conn
+            self.discard(conn)
+
+    def release(self, conn, discard=False):
+        with self.cond:
+            created = self.created.get(id(conn))
+            now = monotonic()
+            if not discard and not self.closed and created is not None and not self.expired(created, now, now):
+                self.idle.append((conn, created, now))
+                self.cond.notify()
+                return
+        self.discard(conn)
+        self.fill()
+
+    def forget(self, conn):
+        # has to be called under the lock
+        if self.created.pop(id(conn), None) is not None:
+            self.size -= 1
+        self.cond.notify()
+
+    def discard(self, conn):
+        with self.cond:
+            self.forget(conn)
+        close(conn)
+
+    def fill(self):
+        # opens connections up to min_idle
+        while True:
+            with self.cond:
+                if self.closed or len(self.idle) >= self.min_idle or self.size >= self.max_size:
+                    return
+                self.size += 1
+            conn = self.new_connection()
+            with self.cond:
+                self.idle.append((conn, self.created[id(conn)], monotonic()))
+                self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            idle = list(self.idle)
+            self.idle.clear()
+            self.cond.notify_all()
+        for conn, _, _ in idle:
+            self.discard(conn)
+
+
+class CursorPool(object):
+    """
+        Free cursors of a connection, every result set is read by its own cursor
+    """
+    def __init__(self, conn, max_size=4):
+        self.conn = conn
+        self.max_size = max_size
+        self.free = []
+        self.used = set()
+
+    def acquire(self):
+        cursor = self.free.pop() if self.free else self.conn.cursor()
+        self.used.add(id(cursor))
+        return cursor
+
+    def release(self, cursor):
+        # False for a cursor of another connection
+        if id(cursor) not in self.used:
+            return False
+        self.used.discard(id(cursor))
+        if len(self.free) < self.max_size:
+            self.free.append(cursor)
+        else:
+            close(cursor)
+        return True
+
+    def close(self):
+        free = self.free
+        self.free = []
+        self.used.clear()
+        for cursor in free:
+            close(cursor)
@@ -0,0 +1,94 @@
+from __future__ import absolute_import
+import re
+import itertools
+from collections import OrderedDict
+
+
+re_param = re.compile(r'%[s%]')
+re_preparable = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.I)
+savepoint = 'sqlmapper_prepare'
+
+
+def numbered_params(sql):
+    """
+        %s placeholders to $1, $2 ..., %% to %,
+        None for named placeholders and for string literals (single or dollar quoted), they aren't parsed
+    """
+    if '%(' in sql or "'" in sql or '$' in sql:
+        return None
+    counter = itertools.count(1)
+    return re_param.sub(lambda m: '%' if m.group(0) == '%%' else '${}'.format(next(counter)), sql)
+
+
+def execute_sql(name, count):
+    if not count:
+        return 'EXECUTE ' + name
+    return 'EXECUTE {} ({})'.format(name, ', '.join(['%s'] * count))
+
+
+class PreparedStatements(object):
+    """
+        Server-side prepared statements of one connection, sql -> name of PREPARE,
+        the least recently used one is deallocated when there are more than max_size
+        generation - schema generation of the engine, statements are deallocated after a schema change
+    """
+    max_failed = 1000
+
+    def __init__(self, max_size=100, generation=0):
+        self.max_size = max_size
+        self.generation = generation
+        self.names = OrderedDict()
+        self.failed = set()  # sql which can't be prepared
+        self.counter = itertools.count(1)
+
+    def lookup(self, sql):
+        name = self.names.pop(sql, None)
+        if name is not None:
+            self.names[sql] = name
+        return name
+
+    def prepare(self, cursor, sql, in_transaction=True):
+        """
+            Returns a name of a new statement or None if sql can't be prepared,
+            in a transaction PREPARE is wrapped by a savepoint, so an error doesn't abort the transaction
+        """
+        if sql in self.failed:
+            return None
+        body = numbered_params(sql) if re_preparable.match(sql) else None
+        if body is None:
+            self.fail(sql)
+            return None
+
+        name = 'sqlmapper_{}'.format(next(self.counter))
+        statement = 'PREPARE {} AS {}'.format(name, body)
+        if in_transaction:
+            statement = 'SAVEPOINT {0}; {1}; RELEASE SAVEPOINT {0}'.format(savepoint, statement)
+        try:
+            cursor.execute(statement)
+        except Exception:
+            if in_transaction:
+                try:
+                    cursor.execute('ROLLBACK TO SAVEPOINT ' + savepoint)
+                except Exception:
+                    # the transaction was aborted before, the statement raises it
+                    pass
+            self.fail(sql)
+            return None
+
+        self.names[sql] = name
+        while len(self.names) > self.max_size:
+            _, old = self.names.popitem(last=False)
+            cursor.execute('DEALLOCATE ' + old)
+        return name
+
+    def fail(self, sql):
+        if len(self.failed) >= self.max_failed:
+            self.failed.clear()
+        self.failed.add(sql)
+
+    def reset(self, cursor, generation):
+        if self.names:
+            cursor.execute('DEALLOCATE ALL')
+        self.names.clear()
+        self.failed.clear()
+        self.generation = generation
@@ -2,18 +2,41 @@
 from __future__ import absolute_import
 import psycopg2
 import threading
+import functools
+import itertools
 import re
-import copy
+import weakref
 from .table import Table
-from .utils import NoValue, validate_name
+from .utils import NoValue, LRUCache, validate_name, chunks
 from .base_engine import BaseEngine
+from .replica import host_options
+from .prepared import PreparedStatements, execute_sql
+from .bulk import RowStream, bulk_rows, row_encoder, copy_value
 
 
 class Engine(BaseEngine):
-    def __init__(self, schema='public', autocreate=None, read_commited=False, **kw):
+    explain_prefix = 'EXPLAIN (FORMAT JSON) '
+
+    def __init__(self, schema='public', autocreate=None, read_commited=False, primary=None, replicas=None, prepare_threshold=None, max_prepared=100, **kw):
+        """
+            primary - host of the primary ('host', 'host:port' or a dict of options), replicas - list of hosts,
+            reads out of a transaction are sent to replicas, see BaseEngine.init_replicas
+            prepare_threshold - a statement is prepared on the server (PREPARE / EXECUTE) after this number of executions,
+            disabled by default: it doesn't work with pgbouncer in transaction mode, and types of parameters are fixed
+            by the first prepare, max_prepared - prepared statements per connection
+        """
         self.read_commited = read_commited
+        self.prepare_threshold = prepare_threshold
+        self.max_prepared = max_prepared
+        self.statements = weakref.WeakKeyDictionary()  # connection -> PreparedStatements
+        self.statements_lock = threading.Lock()
+        self.executions = LRUCache(1000)  # sql -> number of executions before it's prepared
+        self.schema_generation = 0
+        if primary:
+            kw.update(host_options(primary))
         self.local = threading.local()
         self.schema = schema
+        self.cursor_id = itertools.count(1)
         super(Engine, self).__init__()
 
         self.db_config = {}
@@ -23,9 +46,31 @@ class Engine(BaseEngine):
         if not self.db_config.get('dbname'):
             self.db_config['dbname'] = kw.get('db')
 
-        self.local.conn = self.get_connection(autocreate_db=autocreate)
+        connect = functools.partial(self.get_connection, autocreate_db=autocreate)
+        self.init_pool(connect, kw)
+        if not self.pool:
+            self.local.conn = connect()
+        self.init_replicas(replicas, kw)
 
     def get_connection(self, autocreate_db=False):
+        conn = self.connect(autocreate_db)
+        cursor = conn.cursor()
+        if self.read_commited:
+            cursor.execute("SET SESSION CHARACTERISTICS AS TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        cursor.execute('SET search_path TO ' + self.schema)
+        cursor.close()
+        conn.commit()
+        return conn
+
+    def get_replica_connection(self, config):
+        conn = psycopg2.connect(**config)
+        conn.autocommit = True
+        cursor = conn.cursor()
+        cursor.execute('SET search_path TO ' + self.schema)
+        cursor.close()
+        return conn
+
+    def connect(self, autocreate_db=False):
         try:
             return psycopg2.connect(**self.db_config)
         except psycopg2.OperationalError as e:
@@ -42,78 +87,149 @@ class Engine(BaseEngine):
             else:
                 raise
 
-    def commit(self):
-        self.local.conn.commit()
-        self.fire_event(True)
-    
-    def rollback(self):
-        self.local.conn.rollback()
-        self.fire_event(False)
+    def ping_connection(self, conn):
+        if conn.closed:
+            return False
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def send(self, cursor, sql, values=None):
+        name = None
+        if values is not None and self.prepare_threshold and cursor.name is None:
+            name = self.prepared(cursor, sql)
+        if name is None:
+            super(Engine, self).send(cursor, sql, values)
+        else:
+            cursor.execute(execute_sql(name, len(values)), values)
 
-    def close(self):
-        self.local.conn.close()
-        self.local.cursor = None
-        self.local.conn = None
+    def prepared(self, cursor, sql):
+        # a name of the prepared statement of the connection, None to send sql as text
+        conn = cursor.connection
+        statements = self.statements.get(conn)
+        if statements is not None:
+            if statements.generation != self.schema_generation:
+                statements.reset(cursor, self.schema_generation)
+            else:
+                name = statements.lookup(sql)
+                if name is not None:
+                    return name
+
+        count = self.executions.get(sql, 0) + 1
+        if count < self.prepare_threshold:
+            self.executions.set(sql, count)
+            return None
+        if statements is None:
+            with self.statements_lock:
+                statements = self.statements[conn] = PreparedStatements(self.max_prepared, self.schema_generation)
+        return statements.prepare(cursor, sql, in_transaction=not conn.autocommit)
+
+    def refresh_schema(self, table=None):
+        # prepared statements are deallocated, a plan of SELECT * can't change its result type
+        self.schema_generation += 1
+        super(Engine, self).refresh_schema(table)
 
     def get_cursor(self):
         self.thread_init()
-        if hasattr(self.local, 'cursor'):
-            return self.local.cursor
-        
-        if not hasattr(self.local, 'conn'):
-            self.local.conn = self.get_connection()
+        cursor = getattr(self.local, 'cursor', None)
+        if cursor:
+            return cursor
 
-        self.local.cursor = cursor = self.local.conn.cursor()
-        if self.read_commited:
-            cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
-        cursor.execute('SET search_path TO ' + self.schema)
+        self.local.cursor = cursor = self.get_conn().cursor()
         return cursor
 
-    def get_table(self, name):
+    def get_stream_cursor(self):
+        # a named cursor is a server-side cursor, rows are fetched by fetchmany
+        return self.get_conn().cursor(name='sqlmapper_{}'.format(next(self.cursor_id)))
+
+    def create_table(self, name):
         return PsqlTable(name, self)
     
     def get_tables(self):
         cursor = self.get_cursor()
-        cursor.execute('SELECT tablename FROM pg_catalog.pg_tables where schemaname=%s', (self.schema,))
+        self.execute(cursor, 'SELECT tablename FROM pg_catalog.pg_tables where schemaname=%s', (self.schema,), operation='schema')
         for row in cursor:
             yield row[0]
 
-    def get_columns(self, table):
-        self.thread_init()
-        result = self.local.tables.get(table)
-        if not result:
-            result = []
-            cursor = self.get_cursor()
-            # get primary key
-
-            primary = set()
-            cursor.execute(
-                'SELECT c.column_name, c.data_type FROM '
-                'information_schema.table_constraints tc '
-                'JOIN information_schema.constraint_column_usage AS ccu USING (constraint_schema, constraint_name) '
-                'JOIN information_schema.columns AS c ON c.table_schema = tc.constraint_schema AND tc.table_name = c.table_name AND ccu.column_name = c.column_name '
-                'where constraint_type = %s and tc.table_name = %s', ('PRIMARY KEY', table))
-            for row in cursor:
-                primary.add(row[0])
-
-            cursor.execute('select column_name, is_nullable, data_type, column_default, numeric_precision, numeric_precision_radix, * from INFORMATION_SCHEMA.COLUMNS where table_catalog=%s and table_schema=%s and table_name=%s', (self.db_config['dbname'], self.schema, table))
-            for row in cursor:
-                result.append({
-                    'name': row[0],
-                    'null': row[1] == 'YES',
-                    'type': row[2],
-                    'default': row[3],
-                    'primary': row[0] in primary
-                    #'auto_increment': False
-                })
-            self.local.tables[table] = result
-        return copy.deepcopy(result)
+    def load_columns(self, table):
+        result = []
+        cursor = self.get_cursor()
+        # get primary key
+
+        primary = set()
+        self.execute(cursor,
+            'SELECT c.column_name, c.data_type FROM '
+            'information_schema.table_constraints tc '
+            'JOIN information_schema.constraint_column_usage AS ccu USING (constraint_schema, constraint_name) '
+            'JOIN information_schema.columns AS c ON c.table_schema = tc.constraint_schema AND tc.table_name = c.table_name AND ccu.column_name = c.column_name '
+            'where constraint_type = %s and tc.table_name = %s', ('PRIMARY KEY', table), table=table, operation='schema')
+        for row in cursor:
+            primary.add(row[0])
+
+        self.execute(cursor, 'select column_name, is_nullable, data_type, column_default, numeric_precision, numeric_precision_radix, * from INFORMATION_SCHEMA.COLUMNS where table_catalog=%s and table_schema=%s and table_name=%s', (self.db_config['dbname'], self.schema, table), table=table, operation='schema')
+        for row in cursor:
+            result.append({
+                'name': row[0],
+                'null': row[1] == 'YES',
+                'type': row[2],
+                'default': row[3],
+                'primary': row[0] in primary
+                #'auto_increment': False
+            })
+        return result
 
 
 class PsqlTable(Table):
+    in_size = 10000
+    temp_create = 'CREATE TEMP TABLE'
+    temp_drop = 'DROP TABLE IF EXISTS'
+
     def __init__(self, *a, **kw):
         super(PsqlTable, self).__init__(*a, quote='"', **kw)
 
+    _compile_increment = Table._compile_increment_returning
+    _increment_result = Table._increment_returning_result
+
+    def _find_many_in(self, ids, key, columns):
+        # an array is bound as one parameter
+        where = '{} = ANY({})'.format(self.cc(self.tablename + '.' + key), self.keyword)
+        for chunk in chunks(ids, self.in_size):
+            for row in self.find((where, list(chunk)), columns=columns):
+                yield row
+
+    def _insert_batch(self, batch):
+        started = self._started()
+        sql, keys, values = self._insert_sql(batch)
+        key = self.get_primary_key()
+        cursor = self.write_cursor
+        if not key:
+            self._execute(cursor, 'insert', sql, tuple(values), started)
+            return [None] * len(batch)
+
+        sql += ' RETURNING ' + self.cc(key)
+        self._execute(cursor, 'insert', sql, tuple(values), started)
+        return [row[0] for row in cursor.fetchall()]
+
+    def bulk_load(self, rows, columns=None, size=1 << 16):
+        """
+            COPY ... FROM STDIN, rows are encoded by reads of size bytes
+        """
+        started = self._started()
+        columns, rows = bulk_rows(rows, columns)
+        if rows is None:
+            return 0
+        sql = 'COPY {} ({}) FROM STDIN'.format(self.cc(self.tablename), ', '.join(map(self.cc, columns)))
+        stream = RowStream(rows, row_encoder(copy_value))
+        self.write_cursor.copy_expert(sql, stream, size)
+        self._forget(missing=True)
+        self._bulk_done(sql, stream.count, started)
+        return stream.count
+
     def add_column(self, name, column_type, not_null=False, default=NoValue, exist_ok=False, primary=False, auto_increment=False, collate=None):
         validate_name(name)
         assert re.match(r'^[\w\d\(\)]+$', column_type), 'Wrong type: {}'.format(column_type)
@@ -150,17 +266,18 @@ class PsqlTable(Table):
         else:
             sql = 'CREATE TABLE {} ({})'.format(self.tablename, scolumn)
 
-        self.cursor.execute(sql, tuple(values))
+        self._execute(self.write_cursor, 'ddl', sql, tuple(values))
         self.engine.commit()
-        self.engine.local.tables[self.tablename] = None
+        self.engine.refresh_schema(self.tablename)
 
     def has_index(self, name):
-        self.cursor.execute('select i.relname '
+        cursor = self.cursor
+        self._execute(cursor, 'schema', 'select i.relname '
             'from pg_class t, pg_class i, pg_index ix, pg_attribute a '
             'where t.oid = ix.indrelid and i.oid = ix.indexrelid '
             'and a.attrelid = t.oid and a.attnum = ANY(ix.indkey) '
             'and t.relkind = %s and t.relname = %s', ('r', self.tablename))
-        for row in self.cursor:
+        for row in cursor:
             if row[0] == name:
                 return True
         return False
@@ -180,4 +297,5 @@ class PsqlTable(Table):
             index_type = 'INDEX'
 
         sql = 'CREATE {} {} ON {} ({})'.format(index_type, self.cc(name), self.cc(self.tablename), column)
-        self.cursor.execute(sql)
+        self._execute(self.write_cursor, 'ddl', sql)
+        self.engine.refresh_schema(self.tablename)
@@ -0,0 +1,79 @@
+from __future__ import absolute_import
+from .utils import is_str, is_bytes
+
+
+class TableQueue(object):
+    """
+        Work queue on a table, rows are claimed by SELECT ... FOR UPDATE SKIP LOCKED,
+        so workers don't wait for each other (MySQL 8, PostgreSQL)
+
+        queue = TableQueue(db, 'job', filter={'status': 'new'}, done={'status': 'done'})
+        with queue.claim(10) as jobs:
+            for job in jobs:
+                ...
+
+        On success claimed rows are acked (updated by `done` or deleted) and the transaction is committed,
+        on an exception the transaction is rolled back and the rows are released for other workers.
+        on_ack(rows) and on_release(rows) are called by on_commit/on_rollback hooks.
+    """
+    def __init__(self, db, table, filter=None, order_by=None, done=None, on_ack=None, on_release=None):
+        self.db = db
+        self.table = db[table] if is_str(table) or is_bytes(table) else table
+        self.filter = filter
+        self.order_by = order_by
+        self.done = done
+        self.on_ack = on_ack
+        self.on_release = on_release
+
+    def claim(self, limit=1):
+        return Claim(self, limit)
+
+    def process(self, fn, limit=1):
+        # fn(rows) is called for claimed rows, returns number of processed rows
+        with self.claim(limit) as rows:
+            if rows:
+                fn(rows)
+        return len(rows)
+
+    def ack(self, rows):
+        if not rows:
+            return
+        table = self.table
+        key = table.get_primary_key()
+        if not key:
+            raise ValueError('No primary key')
+        ids = [row[key] for row in rows]
+        where = '{} IN ({})'.format(table.cc(key), ', '.join([table.keyword] * len(ids)))
+        filter = (where,) + tuple(ids)
+        if self.done:
+            table.update(filter, self.done)
+        else:
+            table.delete(filter)
+
+
+class Claim(object):
+    def __init__(self, queue, limit):
+        self.queue = queue
+        self.limit = limit
+        self.rows = None
+
+    def __enter__(self):
+        queue = self.queue
+        self.rows = rows = list(queue.table.find(queue.filter, limit=self.limit, for_update='skip_locked', order_by=queue.order_by))
+        if rows:
+            if queue.on_ack:
+                queue.db.on_commit(lambda: queue.on_ack(rows))
+            if queue.on_release:
+                queue.db.on_rollback(lambda: queue.on_release(rows))
+        return rows
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.queue.db.rollback()
+            return False
+        try:
+            self.queue.ack(self.rows)
+        except Exception:
+            self.queue.db.rollback()
+            raise
+        self.queue.db.commit()
@@ -0,0 +1,104 @@
+from __future__ import absolute_import
+import itertools
+import threading
+from .pool import close
+from .utils import monotonic, is_str
+
+
+def host_options(options):
+    # 'host', 'host:port' or a dict of connection options
+    if not is_str(options):
+        return dict(options)
+    host, _, port = options.partition(':')
+    result = {'host': host}
+    if port:
+        result['port'] = int(port)
+    return result
+
+
+class Replica(object):
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.latency = None  # moving average of statements of a read, seconds
+        self.down_until = 0
+
+    def report(self, seconds, alpha=0.2):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += alpha * (seconds - self.latency)
+
+
+class ReplicaSet(object):
+    """
+        Read replicas, each one has a pool of autocommit connections,
+        a cursor is taken for one read and returned with its connection after it
+        select - 'round_robin' or 'latency' (the least moving average of reads)
+        down_time - seconds a replica is skipped after a connection error
+    """
+    def __init__(self, replicas, select='round_robin', down_time=5.0):
+        assert select in ('round_robin', 'latency'), 'Wrong replica select: {}'.format(select)
+        self.replicas = replicas
+        self.select = select
+        self.down_time = down_time
+        self.counter = itertools.count()
+        self.borrowed = {}  # id(cursor) -> [replica, conn, seconds of statements]
+        self.lock = threading.Lock()
+
+    def candidates(self):
+        now = monotonic()
+        alive = [r for r in self.replicas if r.down_until <= now]
+        if self.select == 'latency':
+            # a replica without samples is tried first
+            return sorted(alive, key=lambda r: r.latency or 0)
+        if not alive:
+            return alive
+        n = next(self.counter) % len(alive)
+        return alive[n:] + alive[:n]
+
+    def acquire(self):
+        # None if all replicas are down, a read goes to the primary then
+        for replica in self.candidates():
+            try:
+                conn = replica.pool.acquire()
+            except Exception:
+                replica.down_until = monotonic() + self.down_time
+                continue
+            try:
+                cursor = conn.cursor()
+            except Exception:
+                replica.pool.release(conn, discard=True)
+                replica.down_until = monotonic() + self.down_time
+                continue
+            with self.lock:
+                self.borrowed[id(cursor)] = [replica, conn, 0.0]
+            return cursor
+
+    def execute(self, send, cursor, sql, values=None):
+        # only statements are timed (a result is buffered by execute), not reading of rows by the application
+        item = self.borrowed.get(id(cursor))
+        if item is None:
+            return send(cursor, sql, values)
+        start = monotonic()
+        try:
+            send(cursor, sql, values)
+        finally:
+            item[2] += monotonic() - start
+
+    def release(self, cursor):
+        # False for a cursor of the primary
+        with self.lock:
+            item = self.borrowed.pop(id(cursor), None)
+        if item is None:
+            return False
+        replica, conn, seconds = item
+        if seconds:
+            replica.report(seconds)
+        close(cursor)
+        replica.pool.release(conn)
+        return True
+
+    def close(self):
+        for replica in self.replicas:
+            replica.pool.close()
@@ -0,0 +1,143 @@
+from __future__ import absolute_import
+from collections import namedtuple
+from .utils import LRUCache, is_int
+
+
+class Row(object):
+    """
+        Compact row, values are stored in a tuple, column names are shared by all rows of a result set
+        row['name'], row.name, row[0]
+    """
+    __slots__ = ('_values',)
+    _fields = ()
+    _index = {}
+
+    def __init__(self, values):
+        self._values = values
+
+    def __getitem__(self, key):
+        if is_int(key):
+            return self._values[key]
+        return self._values[self._index[key]]
+
+    def __getattr__(self, name):
+        try:
+            return self._values[self._index[name]]
+        except KeyError:
+            raise AttributeError(name)
+
+    def get(self, key, default=None):
+        i = self._index.get(key)
+        if i is None:
+            return default
+        return self._values[i]
+
+    def keys(self):
+        return list(self._fields)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return list(zip(self._fields, self._values))
+
+    def as_dict(self):
+        return dict(zip(self._fields, self._values))
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            return self._fields == other._fields and self._values == other._values
+        if isinstance(other, dict):
+            return self.as_dict() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Row({})'.format(', '.join('{}={!r}'.format(k, v) for k, v in zip(self._fields, self._values)))
+
+
+row_classes = LRUCache(256)
+
+
+def row_class(fields, row_type=Row):
+    key = (row_type, fields)
+    cls = row_classes.get(key)
+    if cls is None:
+        if row_type is Row:
+            cls = type('Row', (Row,), {
+                '__slots__': (),
+                '_fields': fields,
+                '_index': dict((name, i) for i, name in enumerate(fields))
+            })
+        else:
+            cls = namedtuple('Row', fields, rename=True)
+        row_classes.set(key, cls)
+    return cls
+
+
+def make_builder(fields, row_type):
+    # returns a function to build a row from a sequence of values, None if the values can be returned as is
+    if row_type is dict:
+        return lambda values: dict(zip(fields, values))
+    if row_type is tuple:
+        return None
+    if row_type is namedtuple:
+        return row_class(fields, namedtuple)._make
+    if row_type is Row:
+        return row_class(fields, Row)
+    raise ValueError('Wrong row_type: {}'.format(row_type))
+
+
+def make_decoder(description, joins=None, row_type=dict):
+    """
+        Builds a decoder for rows of a result set, it's computed once by cursor.description
+        Returns None if rows can be used without decoding
+    """
+    names = tuple(col[0] for col in description)
+    if not joins or '__divider' not in names:
+        return make_builder(names, row_type)
+
+    # split columns by __divider: main columns, then a segment per join
+    bounds = [i for i, name in enumerate(names) if name == '__divider']
+    main = names[:bounds[0]]
+    segments = []
+    for n, start in enumerate(bounds):
+        start += 1
+        end = bounds[n + 1] if n + 1 < len(bounds) else len(names)
+        fields = names[start:end]
+        join = joins[n]
+        key = join['key']
+        key_index = fields.index(key) if key in fields else None
+        segments.append((join['alias'], start, end, key_index, make_builder(fields, row_type) or tuple))
+
+    main_size = len(main)
+    fields = main + tuple(s[0] for s in segments)
+    build = make_builder(fields, row_type) or tuple
+
+    def decode(row):
+        values = list(row[:main_size])
+        for alias, start, end, key_index, build_join in segments:
+            part = row[start:end]
+            if key_index is not None and part[key_index] is None:
+                values.append(None)
+            else:
+                values.append(build_join(part))
+        return build(tuple(values))
+
+    return decode
@@ -0,0 +1,96 @@
+from __future__ import absolute_import
+import threading
+
+
+class Column(object):
+    """
+        Immutable column descriptor, column['name'], column.name
+    """
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        object.__setattr__(self, '_data', dict(data))
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __getattr__(self, name):
+        try:
+            return self._data[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Column is immutable')
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def keys(self):
+        return self._data.keys()
+
+    def items(self):
+        return self._data.items()
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        if isinstance(other, Column):
+            other = other._data
+        return self._data == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self._data['name'])
+
+    def __repr__(self):
+        return 'Column({!r})'.format(self._data)
+
+
+class TableSchema(object):
+    __slots__ = ('columns', 'index', 'primary')
+
+    def __init__(self, columns):
+        self.columns = tuple(Column(c) for c in columns)
+        self.index = dict((c['name'], c) for c in self.columns)
+        self.primary = None
+        for c in self.columns:
+            if c['primary']:
+                self.primary = c['name']
+                break
+
+
+class SchemaCache(object):
+    """
+        Process-wide cache of table schemas, shared by all threads of an engine
+    """
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, table):
+        return self.data.get(table)
+
+    def set(self, table, columns):
+        schema = TableSchema(columns)
+        if schema.columns:
+            # a table without columns doesn't exist yet
+            with self.lock:
+                self.data[table] = schema
+        return schema
+
+    def invalidate(self, table=None):
+        with self.lock:
+            if table is None:
+                self.data.clear()
+            else:
+                self.data.pop(table, None)
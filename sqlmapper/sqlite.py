@@ -1,58 +1,213 @@
 
 from __future__ import absolute_import
 import sqlite3
-import copy
+import threading
+import time
+import weakref
 from .table import Table
-from .utils import validate_name, NoValue, quote_key
+from .utils import validate_name, NoValue, quote_key, is_int, monotonic, PY3
 from .base_engine import BaseEngine
 
 
+class Reader(object):
+    # a holder of a reader connection in the thread-local storage, it's collected when the thread exits
+    def __init__(self, conn):
+        self.conn = conn
+
+
 class Engine(BaseEngine):
-    def __init__(self, **kw):
-        self.conn = sqlite3.connect(kw.get('db') or ':memory:')
-        self.cursor = None
+    """
+        One connection for writes, it's taken by a thread with the first write till commit/rollback,
+        reads are run on a connection per thread (WAL allows to read in parallel with the writer),
+        it is closed when the thread exits. A writer of an exited thread is rolled back by the next writer.
+        An in-memory database can't be shared by connections, so reads use the writer connection
+        and see uncommitted writes of other threads.
+        db.cursor is a cursor of the writer, raw statements are a part of the write transaction.
+
+        wal - journal_mode=WAL for a file database
+        synchronous - OFF, NORMAL, FULL, EXTRA
+        mmap_size, cache_size - pragmas for every connection
+        timeout - seconds to wait for the writer
+    """
+    explain_prefix = 'EXPLAIN QUERY PLAN '
+    explain_rollback = False  # a side connection of sqlite is in autocommit mode or is the writer
+
+    def __init__(self, db=None, wal=True, synchronous=None, mmap_size=None, cache_size=None, timeout=5.0, **kw):
+        self.db = db or ':memory:'
+        self.memory = self.db == ':memory:' or self.db.startswith('file::memory:')
+        self.timeout = timeout
+        self.local = threading.local()
+
+        self.pragmas = []
+        if synchronous is not None:
+            synchronous = str(synchronous).upper()
+            assert synchronous in ('0', '1', '2', '3', 'OFF', 'NORMAL', 'FULL', 'EXTRA'), 'Wrong synchronous: {}'.format(synchronous)
+            self.pragmas.append('PRAGMA synchronous = {}'.format(synchronous))
+        if mmap_size is not None:
+            assert is_int(mmap_size)
+            self.pragmas.append('PRAGMA mmap_size = {}'.format(mmap_size))
+        if cache_size is not None:
+            assert is_int(cache_size)
+            self.pragmas.append('PRAGMA cache_size = {}'.format(cache_size))
+
+        self.write_lock = threading.Lock()
+        self.writer_owner = None  # a thread which holds write_lock
+        self.owner_lock = threading.Lock()
+        self.readers = {}  # weakref of Reader -> connection
+        self.readers_lock = threading.Lock()
+        self.conn = self.writer = self.connect()
+        if wal and not self.memory:
+            self.writer.execute('PRAGMA journal_mode = WAL')
         super(Engine, self).__init__()
 
+    def connect(self, isolation_level=''):
+        # connections are shared by threads, access to them is serialized by the engine
+        conn = sqlite3.connect(self.db, timeout=self.timeout, check_same_thread=False, isolation_level=isolation_level)
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+        return conn
+
+    def get_conn(self):
+        if self.memory or getattr(self.local, 'writing', False):
+            return self.writer
+        reader = getattr(self.local, 'reader', None)
+        if reader is None:
+            # autocommit, every select reads the last committed state
+            reader = self.local.reader = Reader(self.connect(isolation_level=None))
+            with self.readers_lock:
+                self.readers[weakref.ref(reader, self.close_reader)] = reader.conn
+        return reader.conn
+
+    def close_reader(self, ref):
+        # the thread has exited
+        with self.readers_lock:
+            conn = self.readers.pop(ref, None)
+        if conn is not None:
+            conn.close()
+
+    def get_side_connection(self):
+        if self.memory:
+            # EXPLAIN doesn't change data, the writer connection is the only one which sees the tables
+            return self.writer
+        return self.connect(isolation_level=None)
+
+    def close_side_connection(self):
+        if self.side_conn is self.writer:
+            self.side_conn = None
+        super(Engine, self).close_side_connection()
+
     def get_cursor(self):
-        if not self.cursor:
-            self.cursor = self.conn.cursor()
-        return self.cursor
+        self.thread_init()
+        conn = self.get_conn()
+        cursor = getattr(self.local, 'cursor', None)
+        if cursor is None or cursor.connection is not conn:
+            cursor = self.local.cursor = conn.cursor()
+        return cursor
+
+    def get_write_cursor(self):
+        self.thread_init()
+        if not getattr(self.local, 'writing', False):
+            if not self.acquire_writer():
+                # hooks of the transaction are run as it can't be continued
+                self.fire_event(False)
+                raise sqlite3.OperationalError('database is locked')
+            self.local.writing = True
+        return self.get_cursor()
+
+    def in_transaction(self):
+        # other reads are run on an autocommit reader (or see the writer out of a transaction)
+        return getattr(self.local, 'writing', False)
+
+    def acquire_writer(self):
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        while True:
+            if PY3:
+                wait = 0.05 if deadline is None else max(min(deadline - monotonic(), 0.05), 0)
+                acquired = self.write_lock.acquire(True, wait)
+            else:
+                # Lock.acquire of python 2 has no timeout
+                acquired = self.write_lock.acquire(False)
+                if not acquired:
+                    time.sleep(0.001)
+            if acquired:
+                self.writer_owner = threading.current_thread()
+                return True
+            if self.take_over_writer():
+                return True
+            if deadline is not None and monotonic() >= deadline:
+                return False
+
+    def take_over_writer(self):
+        owner = self.writer_owner
+        if owner is None or owner.is_alive():
+            return False
+        with self.owner_lock:
+            if self.writer_owner is not owner:
+                return False
+            self.writer_owner = threading.current_thread()
+        # the owner has exited without commit/rollback, its writes are rolled back and the lock is passed on
+        self.writer.rollback()
+        return True
+
+    def get_stream_cursor(self):
+        return self.get_conn().cursor()
+
+    def release_writer(self):
+        if getattr(self.local, 'writing', False):
+            self.local.writing = False
+            self.writer_owner = None
+            self.write_lock.release()
 
     def commit(self):
-        self.conn.commit()
+        if getattr(self.local, 'writing', False):
+            try:
+                self.writer.commit()
+            finally:
+                self.release_writer()
         self.fire_event(True)
-    
+
     def rollback(self):
-        self.conn.rollback()
+        if getattr(self.local, 'writing', False):
+            try:
+                self.writer.rollback()
+            finally:
+                self.release_writer()
         self.fire_event(False)
 
     def close(self):
-        self.conn.close()
-        self.conn = None
-
-    def get_columns(self, table):
-        result = self.local.tables.get(table)
-        if not result:
-            result = []
-            cursor = self.get_cursor()
-            cursor.execute('PRAGMA table_info({})'.format(table))
-            for row in cursor:
-                result.append({
-                    'name': row[1],
-                    'type': row[2],
-                    'notnull': row[3] == 1,
-                    'default': row[4],
-                    'primary': row[5] == 1
-                })
-            self.local.tables[table] = result
-        return copy.deepcopy(result)
-
-    def get_table(self, name):
+        with self.readers_lock:
+            readers = self.readers
+            self.readers = {}
+        for conn in readers.values():
+            conn.close()
+        self.close_side_connection()
+        self.close_cursors()
+        self.writer.close()
+        self.writer = self.conn = None
+        self.local.reader = None
+        self.local.cursor = None
+        self.release_writer()
+
+    def load_columns(self, table):
+        result = []
+        cursor = self.get_cursor()
+        self.execute(cursor, 'PRAGMA table_info({})'.format(table), table=table, operation='schema')
+        for row in cursor:
+            result.append({
+                'name': row[1],
+                'type': row[2],
+                'notnull': row[3] == 1,
+                'default': row[4],
+                'primary': row[5] == 1
+            })
+        return result
+
+    def create_table(self, name):
         return SqliteTable(name, self, keyword='?')
 
     def get_tables(self):
         cursor = self.get_cursor()
-        cursor.execute('SELECT name FROM sqlite_master WHERE type = ?', ('table',))
+        self.execute(cursor, 'SELECT name FROM sqlite_master WHERE type = ?', ('table',), operation='schema')
         for row in cursor:
             yield row[0]
 
@@ -85,6 +240,40 @@ sqlite_types = {
 
 
 class SqliteTable(Table):
+    max_params = 999
+    temp_create = 'CREATE TEMP TABLE'
+    temp_drop = 'DROP TABLE IF EXISTS'
+
+    def _find_many_temp(self, ids, key, columns):
+        # out of a write transaction a temporary table would take the writer, so ids are sent by chunks
+        if not self.engine.in_transaction():
+            return self._find_many_in(ids, key, columns)
+        return super(SqliteTable, self)._find_many_temp(ids, key, columns)
+
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        _compile_increment = Table._compile_increment_returning
+        _increment_result = Table._increment_returning_result
+    else:
+        def _compile_increment(self, column, shape):
+            sql = 'UPDATE {0} SET {1} = {1} + ?'.format(self.cc(self.tablename), self.cc(column))
+            where = self._build_where(shape)
+            if where:
+                sql += ' WHERE ' + where
+            return sql
+
+        def _increment_result(self, cursor, filter, column):
+            # the row is locked by the write transaction
+            if not cursor.rowcount:
+                return None
+            return self.find_one(filter, columns=column)[column]
+
+    def _generated_ids(self, cursor, count):
+        # sqlite returns the last rowid of a multi-row insert
+        last = cursor.lastrowid
+        if not last:
+            return [None] * count
+        return list(range(last - count + 1, last + 1))
+
     def add_column(self, name, type, default=NoValue, exist_ok=False, primary=False, auto_increment=False, not_null=False):
         validate_name(name)
 
@@ -116,12 +305,13 @@ class SqliteTable(Table):
         else:
             sql = 'CREATE TABLE {} ({})'.format(self.tablename, scolumn)
 
-        self.cursor.execute(sql, tuple(values))
-        self.engine.local.tables[self.tablename] = None
+        self._execute(self.write_cursor, 'ddl', sql, tuple(values))
+        self.engine.refresh_schema(self.tablename)
 
     def has_index(self, name):
-        self.cursor.execute('PRAGMA index_list({})'.format(self.tablename))
-        for row in self.cursor:
+        cursor = self.cursor
+        self._execute(cursor, 'schema', 'PRAGMA index_list({})'.format(self.tablename))
+        for row in cursor:
             if row[1] == name:
                 return True
         return False
@@ -140,10 +330,11 @@ class SqliteTable(Table):
             self.tablename,
             column
         )
-        self.cursor.execute(sql)
+        self._execute(self.write_cursor, 'ddl', sql)
+        self.engine.refresh_schema(self.tablename)
 
-    def _build_filter(self, filter):
-        s, v = super(SqliteTable, self)._build_filter(filter)
-        if isinstance(filter, (list, tuple)) and s:
+    def _build_where(self, shape):
+        s = super(SqliteTable, self)._build_where(shape)
+        if shape and shape[0] == 'raw' and s:
             s = s.replace('%s', '?')
-        return s, v
+        return s
@@ -1,10 +1,34 @@
 
 from __future__ import absolute_import
 import re
-from .utils import NoValue, validate_name, quote_key, format_func, is_bytes, is_int, is_str
+import itertools
+from collections import OrderedDict
+from .row import make_decoder
+from .columns import read_columns
+from .instrument import QueryEvent, clock
+from .bulk import bulk_rows
+from .utils import NoValue, validate_name, quote_key, format_func, is_bytes, is_int, is_str, iter_batches, freeze, chunks
+
+
+temp_names = itertools.count(1)
+
+lock_modes = {
+    True: ' FOR UPDATE',
+    'skip_locked': ' FOR UPDATE SKIP LOCKED',
+    'nowait': ' FOR UPDATE NOWAIT'
+}
 
 
 class Table(object):
+    max_params = 65535
+    max_packet = 1 << 22
+    fetch_size = 1000
+    in_size = 1000
+    temp_table_threshold = 10000
+    temp_create = 'CREATE TEMPORARY TABLE'
+    temp_drop = 'DROP TEMPORARY TABLE IF EXISTS'
+    cache_ttl = None  # seconds, results of find/count are cached if the engine has result_cache
+
     def __init__(self, name, engine, keyword='%s', quote='`'):
         self.tablename = name
         self.engine = engine
@@ -18,15 +42,35 @@ class Table(object):
     def cursor(self):
         return self.engine.get_cursor()
 
+    @property
+    def write_cursor(self):
+        if self.engine.result_cache is not None:
+            self.engine.touch_table(self.tablename)
+        return self.engine.get_write_cursor()
+
     def describe(self):
         return self.engine.get_columns(self.tablename)
 
     def get_column(self, name):
-        for column in self.describe():
-            if column['name'] == name:
-                return column
+        return self.engine.get_schema(self.tablename).index.get(name)
+
+    def get_primary_key(self):
+        return self.engine.get_schema(self.tablename).primary
+
+    def refresh(self):
+        # drops cached schema of the table
+        self.engine.refresh_schema(self.tablename)
+
+    def _started(self):
+        # start of a call, time of building sql is measured only for listeners
+        if self.engine.listeners:
+            return clock()
+
+    def _execute(self, cursor, operation, sql, values=None, started=None, emit_event=True):
+        return self.engine.execute(cursor, sql, values, self.tablename, operation, started, emit_event)
 
     def insert(self, data):
+        started = self._started()
         keys = []
         values = []
         items = []
@@ -36,54 +80,388 @@ class Table(object):
             items.append(self.keyword)
 
         sql = 'INSERT INTO {} ({}) VALUES ({})'.format(self.cc(self.tablename), ', '.join(keys), ', '.join(items))
-        self.cursor.execute(sql, tuple(values))
-        assert self.cursor.rowcount == 1
-        return self.cursor.lastrowid
+        cursor = self.write_cursor
+        self._execute(cursor, 'insert', sql, tuple(values), started)
+        assert cursor.rowcount == 1
+        self._forget(missing=True)
+        return cursor.lastrowid
 
-    def _build_filter(self, filter):
+    def insert_many(self, rows, batch_size=1000):
+        """
+            Inserts rows with multi-row INSERT statements, returns a list of primary keys
+        """
+        result = []
+        for batch in iter_batches(rows, batch_size, self.max_params, self.max_packet):
+            result.extend(self._insert_batch(batch))
+        self._forget(missing=True)
+        return result
+
+    def bulk_load(self, rows, columns=None):
+        """
+            Loads a large number of rows by the bulk path of the engine: COPY (PostgreSQL),
+            LOAD DATA LOCAL INFILE (MySQL), executemany (SQLite), rows are encoded while they are sent
+            rows - iterable of dicts, or of sequences in order of columns
+            Returns a number of rows, the load is a part of the transaction
+        """
+        started = self._started()
+        columns, rows = bulk_rows(rows, columns)
+        if rows is None:
+            return 0
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(self.cc(self.tablename), ', '.join(map(self.cc, columns)), ', '.join([self.keyword] * len(columns)))
+        cursor = self.write_cursor
+        cursor.executemany(sql, rows)
+        self._forget(missing=True)
+        self._bulk_done(sql, cursor.rowcount, started)
+        return cursor.rowcount
+
+    def _bulk_done(self, sql, count, started):
+        # listeners get one event for the load
+        if started is not None:
+            event = QueryEvent(sql, None, self.tablename, 'bulk_load')
+            event.db_time = clock() - started
+            event.rows = count
+            self.engine.emit(event)
+
+    def _insert_sql(self, batch):
+        keys = list(batch[0].keys())
+        values = []
+        for row in batch:
+            if len(row) != len(keys):
+                raise ValueError('All rows must have the same columns')
+            for key in keys:
+                values.append(row[key])
+
+        items = '({})'.format(', '.join([self.keyword] * len(keys)))
+        sql = 'INSERT INTO {} ({}) VALUES {}'.format(self.cc(self.tablename), ', '.join(map(self.cc, keys)), ', '.join([items] * len(batch)))
+        return sql, keys, values
+
+    def upsert(self, rows, key=None, update=None, batch_size=1000):
+        """
+            Inserts rows, updates existing ones on conflict of key columns (primary key by default)
+            update - columns to update, all columns except key by default
+        """
+        if isinstance(rows, dict):
+            rows = [rows]
+        key = key or self.get_primary_key()
+        if not key:
+            raise ValueError('No primary key')
+        if not isinstance(key, (list, tuple)):
+            key = [key]
+
+        for batch in iter_batches(rows, batch_size, self.max_params, self.max_packet):
+            started = self._started()
+            batch = self._unique_rows(batch, key)
+            sql, keys, values = self._insert_sql(batch)
+            if update is None:
+                columns = [k for k in keys if k not in key]
+            else:
+                columns = update
+            sql += self._upsert_clause(key, columns)
+            self._execute(self.write_cursor, 'upsert', sql, tuple(values), started)
+        self._forget()
+
+    def _unique_rows(self, batch, key):
+        # a row can't be updated twice by one statement (PostgreSQL), the last one of a key wins
+        unique = OrderedDict()
+        for row in batch:
+            try:
+                ident = tuple([row[k] for k in key])
+            except KeyError:
+                # no key, the row is inserted
+                ident = id(row)
+            unique[ident] = row
+        return list(unique.values())
+
+    def _upsert_clause(self, key, columns):
+        sql = ' ON CONFLICT ({}) DO '.format(', '.join(map(self.cc, key)))
+        if not columns:
+            return sql + 'NOTHING'
+        return sql + 'UPDATE SET ' + ', '.join('{0} = EXCLUDED.{0}'.format(self.cc(c)) for c in columns)
+
+    def _insert_batch(self, batch):
+        started = self._started()
+        sql, keys, values = self._insert_sql(batch)
+        cursor = self.write_cursor
+        self._execute(cursor, 'insert', sql, tuple(values), started)
+        assert cursor.rowcount == len(batch)
+
+        key = self.get_primary_key()
+        if key in keys:
+            ids = [row[key] for row in batch]
+            if any(i is not None for i in ids):
+                # ids of NULL keys aren't known when explicit ids are mixed in
+                return ids
+        return self._generated_ids(cursor, len(batch))
+
+    def _generated_ids(self, cursor, count):
+        # the first id of a multi-row insert, ids of a simple insert are consecutive
+        first = cursor.lastrowid
+        if not first:
+            return [None] * count
+        return list(range(first, first + count))
+
+    def _filter_shape(self, filter):
+        # returns a hashable shape of the filter (the part the sql depends on) and values to bind
         if filter is None:
             return None, []
         elif isinstance(filter, dict):
             keys = []
             values = []
             for k, v in filter.items():
+                keys.append((k, v is None))
+                if v is not None:
+                    values.append(v)
+            return ('dict', tuple(keys)), values
+        elif isinstance(filter, (list, tuple)):
+            return ('raw', filter[0]), list(filter[1:])
+        elif self._is_pk(filter):
+            return ('pk',), [filter]
+        else:
+            raise NotImplementedError
+
+    def _build_where(self, shape):
+        if shape is None:
+            return None
+        kind = shape[0]
+        if kind == 'dict':
+            keys = []
+            for k, is_null in shape[1]:
                 if '.' in k:
                     k = self.cc(k)
                 else:
                     k = self.cc(self.tablename + '.' + k)
-                if v is None:
+                if is_null:
                     keys.append(k + ' is NULL')
                 else:
                     keys.append(k + '=' + self.keyword)
-                    values.append(v)
-            sql = ' AND '.join(keys)
-            return sql, values
-        elif isinstance(filter, (list, tuple)):
-            return filter[0], filter[1:]
-        elif is_int(filter) or is_str(filter) or is_bytes(filter):
+            return ' AND '.join(keys)
+        elif kind == 'raw':
+            return shape[1]
+        else:
             # find by primary key
-            key = None
-            for column in self.describe():
-                if column['primary']:
-                    key = column['name']
-                    break
-            else:
+            key = self.get_primary_key()
+            if not key:
                 raise ValueError('No primary key')
-            return '{} = {}'.format(self.cc(key), self.keyword), [filter]
+            return '{} = {}'.format(self.cc(key), self.keyword)
+
+    def _build_filter(self, filter):
+        shape, values = self._filter_shape(filter)
+        return self._build_where(shape), values
+
+    def _compiled(self, key, build, *a):
+        cache = self.engine.sql_cache
+        result = cache.get(key)
+        if result is None:
+            result = build(*a)
+            cache.set(key, result)
+        return result
+
+    def find_one(self, filter=None, join=None, left_join=None, for_update=False, columns=None, order_by=None, row_type=dict, cache=None):
+        """
+            With identity_map of the engine a row by primary key which is read in an open transaction
+            (on the primary or the SQLite writer) is loaded once, the same dict is returned till commit/rollback
+        """
+        engine = self.engine
+        mapped = engine.identity_map and not (join or left_join or columns) and row_type is dict and self._is_pk(filter)
+        if mapped:
+            key = (self.tablename, filter)
+            identity = getattr(engine.local, 'identity', None)
+            if identity and not for_update and key in identity:
+                return identity[key]
+        result = list(self.find(filter, limit=1, join=join, left_join=left_join, for_update=for_update, columns=columns, order_by=order_by, row_type=row_type, cache=cache))
+        row = result[0] if result else None
+        if mapped and engine.in_transaction():
+            engine.get_identity_map()[key] = row
+        return row
+
+    def _is_pk(self, filter):
+        return is_int(filter) or is_str(filter) or is_bytes(filter)
+
+    def _forget(self, filter=None, deleted=False, missing=False):
+        # keeps the identity map consistent with a write of the table:
+        # a row by primary key is dropped (or marked as deleted), other filters drop all rows of the table,
+        # missing=True drops only rows which were not found (an insert)
+        identity = getattr(self.engine.local, 'identity', None)
+        if not identity:
+            return
+        if self._is_pk(filter):
+            key = (self.tablename, filter)
+            if deleted:
+                identity[key] = None
+            else:
+                identity.pop(key, None)
+            return
+        for key in [k for k, row in identity.items() if k[0] == self.tablename and (row is None or not missing)]:
+            del identity[key]
+
+    def find_many(self, ids, key=None, columns=None):
+        """
+            Loads rows by primary key (or by the key column), returns a dict id -> row
+            Ids are sent by chunks with IN (...), a long list is loaded to a temporary table
+        """
+        key = key or self.get_primary_key()
+        if not key:
+            raise ValueError('No primary key')
+        if columns:
+            if not isinstance(columns, (list, tuple)):
+                columns = [columns]
+            if key not in columns:
+                columns = [key] + list(columns)
+
+        ids = list(OrderedDict.fromkeys(ids))
+        if len(ids) > self.temp_table_threshold:
+            rows = self._find_many_temp(ids, key, columns)
         else:
-            raise NotImplementedError
+            rows = self._find_many_in(ids, key, columns)
+
+        result = {}
+        for row in rows:
+            result[row[key]] = row
+        return result
+
+    def _find_many_in(self, ids, key, columns):
+        column = self.cc(self.tablename + '.' + key)
+        size = min(self.in_size, self.max_params)
+        for chunk in chunks(ids, size):
+            # a short chunk is padded by its last id to a power of two, so there are few shapes of sql to cache
+            n = min(1 << (len(chunk) - 1).bit_length(), size)
+            chunk = list(chunk) + [chunk[-1]] * (n - len(chunk))
+            where = '{} IN ({})'.format(column, ', '.join([self.keyword] * n))
+            for row in self.find((where,) + tuple(chunk), columns=columns):
+                yield row
+
+    def _find_many_temp(self, ids, key, columns):
+        column = self.get_column(key)
+        if not column:
+            raise ValueError('No column: {}'.format(key))
+        # a connection can be shared by threads (SQLite in memory), so a name is unique per call
+        tmp = self.cc('tmp_{}_ids_{}'.format(self.tablename, next(temp_names)))
+        # a temporary table is a write, it's run on the primary in the transaction of the thread
+        cursor = self.write_cursor
 
-    def find_one(self, filter=None, join=None, left_join=None, for_update=False, columns=None, order_by=None):
-        result = list(self.find(filter, limit=1, join=join, for_update=for_update, columns=columns, order_by=order_by))
-        if result:
-            return result[0]
+        self._execute(cursor, 'find_many', '{} {} ({})'.format(self.temp_create, tmp, self._temp_key(column['type'])))
+        try:
+            for chunk in chunks(ids, min(self.in_size, self.max_params)):
+                sql = 'INSERT INTO {} (id) VALUES {}'.format(tmp, ', '.join(['({})'.format(self.keyword)] * len(chunk)))
+                self._execute(cursor, 'find_many', sql, tuple(chunk))
 
-    def find(self, filter=None, limit=None, join=None, left_join=None, for_update=False, columns=None, group_by=None, order_by=None, distinct=False):
+            if columns:
+                columns = ', '.join(map(lambda n: format_func(n, self.quote), columns))
+            else:
+                columns = '{}.*'.format(self.cc(self.tablename))
+            self._execute(cursor, 'find_many', 'SELECT {} FROM {} JOIN {} ON {}.id = {}'.format(
+                columns,
+                self.cc(self.tablename),
+                tmp,
+                tmp,
+                self.cc(self.tablename + '.' + key)
+            ))
+            rows = cursor.fetchall()
+            decode = make_decoder(cursor.description)
+        finally:
+            try:
+                self._execute(cursor, 'find_many', '{} {}'.format(self.temp_drop, tmp))
+            except Exception:
+                pass
+        return map(decode, rows)
+
+    def _temp_key(self, column_type):
+        return 'id {} PRIMARY KEY'.format(column_type)
+
+    def iterate_chunks(self, filter=None, chunk_size=1000, order_key=None, chunks=False, columns=None):
+        """
+            Scans the table by keyset pagination: WHERE key > last ORDER BY key LIMIT chunk_size
+            order_key has to be unique, primary key by default
+            Yields rows, or lists of rows if chunks=True
+            A transaction without writes is committed between chunks, so a chunk sees rows committed after the scan has started
+        """
+        key = order_key or self.get_primary_key()
+        if not key:
+            raise ValueError('No primary key')
+        if columns:
+            if not isinstance(columns, (list, tuple)):
+                columns = [columns]
+            if key not in columns:
+                columns = [key] + list(columns)
+        assert is_int(chunk_size) and chunk_size > 0
+
+        shape, values = self._filter_shape(filter)
+        last = NoValue
+        while True:
+            started = self._started()
+            after = last is not NoValue
+            cache_key = ('chunk', self.tablename, shape, key, freeze(columns), chunk_size, after)
+            sql = self._compiled(cache_key, self._compile_chunk, shape, key, columns, chunk_size, after)
+            params = values + [last] if after else values
+            if after:
+                self.engine.end_read()
+
+            cursor = self.cursor
+            self._execute(cursor, 'iterate_chunks', sql, tuple(params), started)
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            rows = list(map(make_decoder(cursor.description), rows))
+            if chunks:
+                yield rows
+            else:
+                for row in rows:
+                    yield row
+            if len(rows) < chunk_size:
+                break
+            last = rows[-1][key]
+
+    def _compile_chunk(self, shape, key, columns, limit, after):
+        if columns:
+            columns = ', '.join(map(lambda n: format_func(n, self.quote), columns))
+        else:
+            columns = '{}.*'.format(self.cc(self.tablename))
+        column = self.cc(self.tablename + '.' + key)
+
+        where = []
+        filter_sql = self._build_where(shape)
+        if filter_sql:
+            where.append('(' + filter_sql + ')')
+        if after:
+            where.append('{} > {}'.format(column, self.keyword))
+
+        sql = 'SELECT {} FROM {}'.format(columns, self.cc(self.tablename))
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY {} LIMIT {}'.format(column, limit)
+        return sql
+
+    def find(self, filter=None, limit=None, join=None, left_join=None, for_update=False, columns=None, group_by=None, order_by=None, distinct=False, stream=False, fetch_size=None, row_type=dict, as_columns=False, cache=None):
         """
             join='subtable.id=column'
             join='subtable as tbl.id=column'
+
+            for_update: True, 'skip_locked' or 'nowait' (MySQL 8, PostgreSQL)
+            stream=True or fetch_size=N reads rows with a server-side cursor in batches of fetch_size
+            row_type: dict, tuple, collections.namedtuple or sqlmapper.Row
+            as_columns=True returns a dict column -> array (numpy array if numpy is installed), 'array' or 'numpy' to choose
+            cache: True or ttl in seconds - use result_cache of the engine, False - skip it, table.cache_ttl by default
         """
+        started = self._started()
+        shape, values = self._filter_shape(filter)
+        key = ('find', self.tablename, shape, freeze(columns), join, left_join, for_update, freeze(group_by), freeze(order_by), limit, distinct)
+        sql, joins = self._compiled(key, self._compile_find, shape, limit, join, left_join, for_update, columns, group_by, order_by, distinct)
+        if for_update:
+            # locked rows are a part of a write transaction
+            self.engine.start_writes()
+        if as_columns:
+            assert not joins
+            return self._fetch_columns(sql, values, stream, fetch_size or self.fetch_size, as_columns, started, not for_update)
+        ttl = None if stream or fetch_size else self._cache_ttl(cache, for_update, (join or left_join,))
+        if ttl is not None:
+            return self._fetch_cached(sql, values, joins, row_type, started, ttl, (join or left_join,))
+        # rows are read lazily, build time is taken before the caller starts to iterate
+        build_time = clock() - started if started is not None else 0.0
+        if stream or fetch_size:
+            return self._fetch_stream(sql, values, joins, fetch_size or self.fetch_size, row_type, build_time)
+        return self._fetch(sql, values, joins, self.fetch_size, row_type, build_time, not for_update)
 
+    def _compile_find(self, shape, limit, join, left_join, for_update, columns, group_by, order_by, distinct):
         if columns:
             assert not join
             if not isinstance(columns, (list, tuple)):
@@ -114,10 +492,7 @@ class Table(object):
 
             key = None
             if left_join:
-                for c in self.engine.get_columns(self.tablename):
-                    if c['primary']:
-                        key = c['name']
-                        break
+                key = self.get_primary_key()
 
             joins.append({
                 'alias': alias,
@@ -128,7 +503,7 @@ class Table(object):
         if distinct:
             sql += 'DISTINCT '
         sql += '{} FROM {}'.format(columns, self.cc(self.tablename))
-        where, values = self._build_filter(filter)
+        where = self._build_where(shape)
         if join:
             sql += join
         if where:
@@ -152,79 +527,276 @@ class Table(object):
             sql += ' LIMIT {}'.format(limit)
 
         if for_update:
-            sql += ' FOR UPDATE'
-
-        self.cursor.execute(sql, tuple(values))
-
-        columns = self.cursor.description
-        if self.cursor.rowcount:
-            for row in self.cursor:
-                join_index = -1
-                join_alias = None
-                join_key = None
-                d = {}
-                for i, value in enumerate(row):
-                    col = columns[i]
-                    column_name = col[0]
-                    if column_name == '__divider':
-                        join_index += 1
-                        join_alias = joins[join_index]['alias']
-                        join_key = joins[join_index]['key']
-                        d[join_alias] = {}
-                        continue
-                    if join_alias:
-                        if column_name == join_key:
-                            if value is None:
-                                d[join_alias] = None
-                        if d[join_alias] is not None:
-                            d[join_alias][column_name] = value
-                    else:
-                        d[column_name] = value
-                yield d
-
-    def update(self, filter=None, update=None, limit=None):
+            sql += self._lock_clause(for_update)
+        return sql, joins
+
+    def _lock_clause(self, for_update):
+        try:
+            return lock_modes[for_update]
+        except KeyError:
+            raise ValueError('Wrong for_update: {}'.format(for_update))
+
+    def _fetch(self, sql, values, joins, fetch_size, row_type, build_time=0.0, read=False):
+        # the cursor is returned to the pool when the result is read or the generator is closed,
+        # read=True allows a replica
+        engine = self.engine
+        cursor = engine.acquire_cursor(read)
+        event = None
+        try:
+            event = self._execute(cursor, 'find', sql, tuple(values), emit_event=False)
+            if event is not None:
+                event.build_time = build_time
+            if not cursor.rowcount:
+                return
+            for rows in self._read_rows(cursor, fetch_size, joins, row_type, event):
+                for row in rows:
+                    yield row
+        finally:
+            engine.release_cursor(cursor)
+            if event is not None:
+                engine.emit(event)
+
+    def _cache_tags(self, joins):
+        tags = [self.tablename]
+        for join in joins:
+            if join:
+                tags.append(re.match(r'\w+', join).group(0))
+        return tags
+
+    def _cache_ttl(self, cache, for_update=False, joins=()):
+        # None if the result is not cached
+        result_cache = self.engine.result_cache
+        if result_cache is None or cache is False or for_update:
+            return None
+        if cache is None or cache is True:
+            ttl = self.cache_ttl
+            if ttl is None:
+                if cache is None:
+                    return None
+                ttl = result_cache.ttl
+        else:
+            ttl = cache
+        if self.engine.is_touched(self._cache_tags(joins)):
+            # the transaction has to read own writes
+            return None
+        return ttl
+
+    def _cached(self, key, tags, ttl, read):
+        # read() is called on a miss
+        cache = self.engine.result_cache
+        result = cache.get(key)
+        if result is None:
+            version = cache.version(tags)
+            result = read()
+            cache.set(key, result, tags, ttl, version)
+        return result
+
+    def _fetch_cached(self, sql, values, joins, row_type, started, ttl, join):
+        def read():
+            engine = self.engine
+            cursor = engine.acquire_cursor(True)
+            try:
+                event = self._execute(cursor, 'find', sql, tuple(values), started, emit_event=False)
+                start = event and clock()
+                rows = cursor.fetchall()
+                if event:
+                    # rowcount of a select is -1 for sqlite
+                    event.db_time += clock() - start
+                    event.rows = len(rows)
+                    engine.emit(event)
+                # only names of columns are kept
+                return tuple((col[0],) for col in cursor.description), tuple(map(tuple, rows))
+            finally:
+                engine.release_cursor(cursor)
+
+        description, rows = self._cached(('find', sql, tuple(map(freeze, values))), self._cache_tags(join), ttl, read)
+        decode = make_decoder(description, joins, row_type)
+        if decode:
+            rows = map(decode, rows)
+        return iter(rows)
+
+    def _read_rows(self, cursor, fetch_size, joins, row_type, event=None):
+        # yields decoded batches of rows, fetch and decode are timed for listeners
+        decode = NoValue
+        while True:
+            start = event and clock()
+            rows = cursor.fetchmany(fetch_size)
+            if event:
+                fetched = clock()
+                event.db_time += fetched - start
+            if not rows:
+                break
+            if decode is NoValue:
+                # a named cursor of psycopg2 has description after the first fetch
+                decode = make_decoder(cursor.description, joins, row_type)
+            if event:
+                if decode:
+                    rows = list(map(decode, rows))
+                event.decode_time += clock() - fetched
+                event.rows += len(rows)
+            elif decode:
+                rows = map(decode, rows)
+            yield rows
+
+    def _fetch_columns(self, sql, values, stream, fetch_size, as_columns, started=None, read=False):
+        engine = self.engine
+        if stream:
+            cursor = engine.get_stream_cursor()
+            release = cursor.close
+        else:
+            cursor = engine.acquire_cursor(read)
+            release = lambda: engine.release_cursor(cursor)
+        try:
+            event = self._execute(cursor, 'find', sql, tuple(values), started, emit_event=False)
+            if event is None:
+                return read_columns(cursor, fetch_size, as_columns)
+            start = clock()
+            result = read_columns(cursor, fetch_size, as_columns)
+            event.decode_time = clock() - start
+            event.rows = len(next(iter(result.values()), ()))
+            engine.emit(event)
+            return result
+        finally:
+            release()
+
+    def _fetch_stream(self, sql, values, joins, fetch_size, row_type, build_time=0.0):
+        engine = self.engine
+        cursor = engine.get_stream_cursor()
+        event = None
+        try:
+            event = self._execute(cursor, 'find', sql, tuple(values), emit_event=False)
+            if event is not None:
+                event.build_time = build_time
+            for rows in self._read_rows(cursor, fetch_size, joins, row_type, event):
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+            if event is not None:
+                engine.emit(event)
+
+    def update(self, filter=None, update=None, limit=None, inc=None):
+        """
+            inc={'value': 1} - SET value = value + 1
+        """
+        assert update or inc
+        started = self._started()
+        shape, values = self._filter_shape(filter)
+        keys = tuple(update.keys()) if update else ()
+        inc_keys = tuple(inc.keys()) if inc else ()
+        sql = self._compiled(('update', self.tablename, keys, inc_keys, shape, limit), self._compile_update, keys, inc_keys, shape, limit)
+        values = [update[k] for k in keys] + [inc[k] for k in inc_keys] + values
+        self._execute(self.write_cursor, 'update', sql, tuple(values), started)
+        self._forget(filter)
+
+    def _compile_update(self, keys, inc_keys, shape, limit):
         up = []
-        values = []
-        for key, value in update.items():
+        for key in keys:
             up.append('{} = {}'.format(self.cc(key), self.keyword))
-            values.append(value)
+        for key in inc_keys:
+            up.append('{0} = {0} + {1}'.format(self.cc(key), self.keyword))
 
         sql = 'UPDATE {} SET {}'.format(self.cc(self.tablename), ', '.join(up))
 
-        where, wvalues = self._build_filter(filter)
+        where = self._build_where(shape)
         if where:
             sql += ' WHERE ' + where
-            values += wvalues
-        
+
         if limit:
             assert is_int(limit)
             sql += ' LIMIT {}'.format(limit)
+        return sql
+
+    def increment(self, filter, column, value=1):
+        """
+            Adds value to the column, returns the new value or None if no row is matched,
+            the filter is meant to match one row (a value of the first one is returned)
+            One UPDATE which returns the new value (RETURNING, LAST_INSERT_ID(expr) of MySQL)
+        """
+        if self._compile_increment is None:
+            return self._increment_locked(filter, column, value)
+
+        started = self._started()
+        shape, values = self._filter_shape(filter)
+        sql = self._compiled(('increment', self.tablename, column, shape), self._compile_increment, column, shape)
+        cursor = self.write_cursor
+        self._execute(cursor, 'increment', sql, tuple([value] + values), started)
+        self._forget(filter)
+        return self._increment_result(cursor, filter, column)
+
+    def _increment_locked(self, filter, column, value):
+        # SELECT ... FOR UPDATE and UPDATE in the transaction
+        row = self.find_one(filter, columns=column, for_update=True)
+        if row is None:
+            return None
+        self.update(filter, inc={column: value})
+        return row[column] + value
+
+    # an engine with UPDATE ... RETURNING sets both
+    _compile_increment = None
+    _increment_result = None
 
-        self.cursor.execute(sql, tuple(values))
+    def _compile_increment_returning(self, column, shape):
+        sql = 'UPDATE {0} SET {1} = {1} + {2}'.format(self.cc(self.tablename), self.cc(column), self.keyword)
+        where = self._build_where(shape)
+        if where:
+            sql += ' WHERE ' + where
+        return sql + ' RETURNING ' + self.cc(column)
+
+    def _increment_returning_result(self, cursor, filter, column):
+        row = cursor.fetchone()
+        if row:
+            return row[0]
 
     def update_one(self, filter=None, update=None):
         self.update(filter, update, limit=1)
 
     def delete(self, filter=None):
-        where, values = self._build_filter(filter)
+        started = self._started()
+        shape, values = self._filter_shape(filter)
+        sql = self._compiled(('delete', self.tablename, shape), self._compile_delete, shape)
+        self._execute(self.write_cursor, 'delete', sql, tuple(values), started)
+        self._forget(filter, deleted=True)
+
+    def _compile_delete(self, shape):
+        where = self._build_where(shape)
 
         sql = 'DELETE FROM {}'.format(self.cc(self.tablename))
         if where:
             sql += ' WHERE {}'.format(where)
-        self.cursor.execute(sql, tuple(values))
+        return sql
+
+    def count(self, filter=None, cache=None):
+        started = self._started()
+        shape, values = self._filter_shape(filter)
+        sql = self._compiled(('count', self.tablename, shape), self._compile_count, shape)
+        engine = self.engine
+
+        def read():
+            cursor = engine.acquire_cursor(read=True)
+            try:
+                self._execute(cursor, 'count', sql, tuple(values), started)
+                return cursor.fetchone()[0]
+            finally:
+                engine.release_cursor(cursor)
+
+        ttl = self._cache_ttl(cache)
+        if ttl is None:
+            return read()
+        return self._cached(('count', sql, tuple(map(freeze, values))), [self.tablename], ttl, read)
 
-    def count(self, filter=None):
-        where, values = self._build_filter(filter)
+    def _compile_count(self, shape):
+        where = self._build_where(shape)
 
         sql = 'SELECT COUNT(*) FROM {}'.format(self.cc(self.tablename))
         if where:
             sql += ' WHERE {}'.format(where)
-        self.cursor.execute(sql, tuple(values))
-        return self.cursor.fetchone()[0]
+        return sql
 
     def drop(self, exist_ok=True):
         sql = 'DROP TABLE '
         if exist_ok:
             sql += 'IF EXISTS '
         sql += self.tablename
-        self.cursor.execute(sql)
+        self._execute(self.write_cursor, 'ddl', sql)
+        self.engine.refresh_schema(self.tablename)
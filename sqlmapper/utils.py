@@ -1,10 +1,14 @@
 
 import sys
 import re
+import time
+import threading
+from collections import OrderedDict
 
 
 PY3 = sys.version_info.major == 3
 NoValue = object()
+monotonic = getattr(time, 'monotonic', time.time)
 
 if PY3:
     def is_int(value):
@@ -65,3 +69,73 @@ def format_func(name, q='`'):
         key = func + '_' + name
 
     return '{}({}) as {}'.format(func, quote_key(name, q), quote_key(key, q).lower())
+
+
+def value_size(value):
+    if is_str(value) or is_bytes(value):
+        # escaped and quoted, utf8 can take more bytes than characters
+        return len(value) * 2 + 2
+    return 8
+
+
+def iter_batches(rows, batch_size, max_params=None, max_packet=None):
+    batch = []
+    params = 0
+    size = 0
+    for row in rows:
+        n = len(row)
+        s = sum(map(value_size, row.values())) if max_packet else 0
+        if batch and (
+            len(batch) >= batch_size or
+            (max_params and params + n > max_params) or
+            (max_packet and size + s > max_packet)
+        ):
+            yield batch
+            batch = []
+            params = 0
+            size = 0
+        batch.append(row)
+        params += n
+        size += s
+    if batch:
+        yield batch
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def freeze(value):
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.data.pop(key, NoValue)
+            if value is NoValue:
+                return default
+            self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
@@ -0,0 +1,69 @@
+import asyncio
+import pytest
+from sqlmapper.aio import Connection
+
+
+async def connect(**kw):
+    db = await Connection(host='127.0.0.1', db='unittest', user='root', autocreate=True, **kw)
+    await db.aio_book.drop()
+    await db.aio_book.add_column('id', 'int', primary=True, auto_increment=True)
+    await db.aio_book.add_column('value', 'int')
+    await db.aio_book.insert_many([{'value': i} for i in range(100)])
+    await db.commit()
+    return db
+
+
+def test_aio_iterate_break():
+    async def main():
+        db = await connect()
+        async with db.aio_book.iterate(fetch_size=10) as rows:
+            async for row in rows:
+                if row['value'] == 5:
+                    break
+        # the unbuffered result is closed, the connection is free
+        assert (await db.aio_book.find_one({'value': 50}))['value'] == 50
+
+        rows = db.aio_book.iterate(fetch_size=10)
+        async for row in rows:
+            break
+        await rows.aclose()
+        assert len(await db.aio_book.find({'value': 7})) == 1
+        db.close()
+
+    asyncio.run(main())
+
+
+def test_aio_iterate_nested():
+    async def main():
+        db = await connect(max_queries=1)
+        async with db.aio_book.iterate() as rows:
+            async for row in rows:
+                with pytest.raises(RuntimeError):
+                    await db.aio_book.find_one(row['id'])
+                break
+        db.close()
+
+        # a pool gives a nested query another connection
+        db = await connect(pool_size=2, max_queries=2)
+        count = 0
+        async with db.aio_book.iterate(fetch_size=10) as rows:
+            async for row in rows:
+                assert (await db.aio_book.find_one(row['id']))['value'] == row['value']
+                count += 1
+        assert count == 100
+        db.close()
+
+    asyncio.run(main())
+
+
+def test_aio_update_inc():
+    async def main():
+        db = await connect()
+        await db.aio_book.update({'value': 5}, inc={'value': 100})
+        await db.aio_book.update(1, {'value': 1}, inc={'value': 2})
+        await db.commit()
+        assert (await db.aio_book.find_one(6))['value'] == 105
+        assert (await db.aio_book.find_one(1))['value'] == 3
+        db.close()
+
+    asyncio.run(main())
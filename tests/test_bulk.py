@@ -0,0 +1,48 @@
+import datetime
+from sqlmapper import Connection
+from sqlmapper.bulk import RowStream, bulk_rows, row_encoder, copy_value, infile_value, iter_slices
+
+
+def test_bulk_encoding():
+    encode = row_encoder(copy_value)
+    assert encode((1, None, True, u'a\tb\\c\nd', b'\x01\xff')) == b'1\t\\N\tt\ta\\tb\\\\c\\nd\t\\\\x01ff\n'
+    assert row_encoder(infile_value)((False, datetime.date(2020, 1, 2), b'a\x00')) == b'0\t2020-01-02\ta\\0\n'
+
+    columns, rows = bulk_rows([{'a': 1, 'b': 2}, {'b': 4, 'a': 3}])
+    assert columns == ['a', 'b'] and list(rows) == [(1, 2), (3, 4)]
+    assert bulk_rows([], ['a']) == (['a'], None)
+
+    stream = RowStream(iter([(i, 'x' * 10) for i in range(100)]), encode)
+    data = b''
+    while True:
+        chunk = stream.read(64)
+        assert len(chunk) <= 64
+        if not chunk:
+            break
+        data += chunk
+    assert stream.count == 100
+    assert data.count(b'\n') == 100 and data.startswith(b'0\txxxxxxxxxx\n1\t')
+
+    assert [list(chunk) for chunk in iter_slices(iter(range(5)), 2)] == [[0, 1], [2, 3], [4]]
+
+
+def test_sqlite_bulk_load():
+    events = []
+    db = Connection(engine='sqlite')
+    db.book.add_column('id', 'int', primary=True, auto_increment=True)
+    db.book.add_column('name', 'text')
+    db.book.add_column('value', 'int')
+    db.add_listener(lambda e: events.append((e.operation, e.rows)))
+
+    assert db.book.bulk_load(((u'book{}'.format(i), i) for i in range(1000)), ['name', 'value']) == 1000
+    assert db.book.bulk_load([{'name': 'last', 'value': None}]) == 1
+    assert db.book.bulk_load([], ['name']) == 0
+    assert events == [('bulk_load', 1000), ('bulk_load', 1)]
+    db.rollback()
+    assert db.book.count() == 0
+
+    db.book.bulk_load(((u'book{}'.format(i), i) for i in range(1000)), ['name', 'value'])
+    db.commit()
+    assert db.book.count() == 1000
+    assert db.book.find_one(1000) == {'id': 1000, 'name': 'book999', 'value': 999}
+    db.close()
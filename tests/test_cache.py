@@ -0,0 +1,139 @@
+import time
+from sqlmapper import Connection, MemoryCache
+
+
+def test_memory_cache():
+    cache = MemoryCache(max_entries=2, ttl=0.1)
+    cache.set('a', 1, ['t1'])
+    cache.set('b', 2, ['t2'])
+    assert cache.get('a') == 1
+    cache.set('c', 3, ['t2'])
+    assert cache.get('b') is None  # LRU
+    assert len(cache) == 2
+
+    cache.invalidate(['t2'])
+    assert cache.get('c') is None and cache.get('a') == 1
+
+    # a result read before invalidation isn't stored
+    version = cache.version(['t1'])
+    cache.invalidate(['t1'])
+    cache.set('d', 4, ['t1'], version=version)
+    assert cache.get('d') is None
+
+    version = cache.version(['t1'])
+    cache.clear()
+    cache.set('d', 4, ['t1'], version=version)
+    assert cache.get('d') is None
+
+    cache.set('e', 5, ['t1'])
+    time.sleep(0.15)
+    assert cache.get('e') is None
+    assert cache.size == 0
+
+    cache = MemoryCache(max_bytes=1000)
+    cache.set('big', ['x' * 100] * 10, ['t'])
+    assert cache.get('big') is None
+    cache.set('a', 'x' * 200, ['t'])
+    cache.set('b', 'x' * 200, ['t'])
+    cache.set('c', 'x' * 200, ['t'])
+    assert cache.get('a') is None and cache.get('c')
+    assert cache.size <= 1000
+
+
+def test_sqlite_result_cache():
+    queries = []
+    cache = MemoryCache()
+    db = Connection(engine='sqlite', result_cache=cache)
+    db.add_listener(lambda e: queries.append(e.operation))
+    db.country.add_column('id', 'int', primary=True, auto_increment=True)
+    db.country.add_column('name', 'text')
+    db.city.add_column('id', 'int', primary=True, auto_increment=True)
+    db.city.add_column('country_id', 'int')
+    db.country.insert_many([{'name': 'Italy'}, {'name': 'Spain'}])
+    db.city.insert({'country_id': 2})
+    db.commit()
+    del queries[:]
+
+    assert db.country.find_one(1, cache=True)['name'] == 'Italy'
+    assert db.country.find_one(1, cache=True)['name'] == 'Italy'
+    assert db.country.find_one(1)['name'] == 'Italy'  # not cached
+    assert db.country.count(cache=30) == 2
+    assert db.country.count(cache=30) == 2
+    assert queries == ['find', 'find', 'count']
+
+    db.country.cache_ttl = 30
+    r = list(db.city.find(join='country.id=country_id', cache=True))
+    assert r[0]['country']['name'] == 'Spain'
+    assert list(db.country.find(row_type=tuple)) == [(1, 'Italy'), (2, 'Spain')]
+    assert list(db.country.find())[0] == {'id': 1, 'name': 'Italy'}
+    assert db.country.find_one(2)['name'] == 'Spain'
+    del queries[:]
+
+    # a transaction reads own writes, other results are dropped on commit
+    db.country.update(2, {'name': 'Portugal'})
+    assert db.country.find_one(2)['name'] == 'Portugal'
+    db.rollback()
+    assert db.country.find_one(2)['name'] == 'Spain'
+    assert queries == ['update', 'find']
+    db.country.update(2, {'name': 'Portugal'})
+    db.commit()
+    assert db.country.find_one(2)['name'] == 'Portugal'
+    assert list(db.city.find(join='country.id=country_id', cache=True))[0]['country']['name'] == 'Portugal'
+    assert db.country.count(cache=False) == 2
+    db.close()
+
+
+def test_sqlite_identity_map(tmp_path):
+    queries = []
+    db = Connection(engine='sqlite', db=str(tmp_path / 'test.db'), identity_map=True)
+    db.add_listener(lambda e: queries.append(e.operation))
+    db.country.add_column('id', 'int', primary=True, auto_increment=True)
+    db.country.add_column('name', 'text')
+    db.country.insert_many([{'name': 'Italy'}, {'name': 'Spain'}])
+    db.commit()
+    del queries[:]
+
+    # out of a transaction reads run on the autocommit reader and aren't mapped
+    assert db.country.find_one(1) == db.country.find_one(1)
+    assert queries == ['find', 'find']
+
+    db.country.update(2, {'name': 'Spain'})
+    del queries[:]
+    row = db.country.find_one(1)
+    assert db.country.find_one(1) is row
+    assert db.country.find_one(3) is None
+    assert db.country.find_one(3) is None
+    assert db.country.find_one(1, row_type=tuple) == (1, 'Italy')  # not mapped
+    assert queries == ['find', 'find', 'find']
+
+    db.country.update(1, {'name': 'France'})
+    assert db.country.find_one(1)['name'] == 'France'
+    db.country.insert({'name': 'Greece'})
+    assert db.country.find_one(3)['name'] == 'Greece'
+    db.country.delete(2)
+    assert db.country.find_one(2) is None
+    db.country.update({'name': 'Greece'}, {'name': 'Malta'})
+    assert db.country.find_one(3)['name'] == 'Malta'
+    db.rollback()
+
+    assert db.country.find_one(1)['name'] == 'Italy'
+    assert getattr(db._engine.local, 'identity', None) is None
+    db.close()
+
+
+def test_psql_result_cache():
+    db = Connection(engine='postgresql', host='127.0.0.1', db='unittest', user='postgres', password='secret', autocreate=True, result_cache=MemoryCache())
+    db.cache_book.drop()
+    db.cache_book.add_column('id', 'int', primary=True, auto_increment=True)
+    db.cache_book.add_column('name', 'text')
+    db.cache_book.insert_many([{'name': 'a'}, {'name': 'b'}, {'name': 'c'}])
+    db.commit()
+    db.cache_book.cache_ttl = 30
+
+    # an array is bound as one parameter
+    assert sorted(db.cache_book.find_many([1, 3])) == [1, 3]
+    assert sorted(db.cache_book.find_many([1, 3])) == [1, 3]
+    assert db.cache_book.count(('id = ANY(%s)', [1, 2])) == 2
+    db.cache_book.drop()
+    db.commit()
+    db.close()
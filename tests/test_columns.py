@@ -0,0 +1,22 @@
+from sqlmapper.columns import ColumnBuilder
+
+
+def build(*batches):
+    builder = ColumnBuilder()
+    for batch in batches:
+        builder.extend(batch)
+    return builder.result(False)
+
+
+def test_column_builder():
+    r = build([1, 2], [3])
+    assert r.typecode == 'q' and list(r) == [1, 2, 3]
+    r = build([1, 2], [0.5], [3])
+    assert r.typecode == 'd' and list(r) == [1.0, 2.0, 0.5, 3.0]
+
+    # a batch of another type falls back to a list, values aren't coerced
+    assert build([1, 2], [True, None]) == [1, 2, True, None]
+    assert build([0.5], [False]) == [0.5, False]
+    assert build([1], ['a']) == [1, 'a']
+    assert build([1], [1 << 70]) == [1, 1 << 70]
+    assert build(['a'], [1]) == ['a', 1]
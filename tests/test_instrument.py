@@ -0,0 +1,110 @@
+import time
+from sqlmapper import Connection, Collector, SlowQueryLog, MemoryCache
+from sqlmapper.instrument import Histogram, fingerprint
+
+
+def test_fingerprint():
+    assert fingerprint('SELECT * FROM `book` WHERE `id` IN (%s, %s, %s) LIMIT 10') == 'SELECT * FROM `book` WHERE `id` IN (...) LIMIT ?'
+    assert fingerprint('INSERT INTO t1 (a, b) VALUES (?, ?), (?, ?), (?, ?)') == 'INSERT INTO t1 (a, b) VALUES (?, ?), ...'
+    assert fingerprint("SELECT  *\n FROM t WHERE name = 'x'") == 'SELECT * FROM t WHERE name = ?'
+
+
+def test_histogram():
+    h = Histogram()
+    for i in range(1, 10001):
+        h.record(i)
+    assert h.count == 10000
+    assert h.min == 1 and h.max == 10000
+    assert h.percentile(0) == 1
+    assert h.percentile(100) == 10000
+    for q in (50, 90, 99):
+        value = h.percentile(q)
+        assert abs(value - q * 100) <= q * 100 / 32.0
+
+    h2 = Histogram()
+    h2.record(20000)
+    h.merge(h2)
+    assert h.max == 20000 and h.count == 10001
+
+
+def test_sqlite_instrument():
+    events = []
+    collector = Collector()
+    db = Connection(engine='sqlite')
+    db.add_listener(collector)
+    db.add_listener(events.append)
+    db.book.add_column('id', 'int', primary=True, auto_increment=True)
+    db.book.add_column('value', 'int')
+    db.book.insert_many([{'value': i} for i in range(10)])
+    for i in range(3):
+        assert len(list(db.book.find({'value': i}))) == 1
+    db.book.update({'value': 1}, {'value': 100})
+    db.commit()
+
+    find = [e for e in events if e.operation == 'find']
+    assert len(find) == 3
+    assert find[0].table == 'book'
+    assert find[0].rows == 1 and find[0].params == 1
+    assert find[0].db_time > 0
+    assert [e.rows for e in events if e.operation in ('insert', 'update')] == [10, 1]
+
+    stats = collector.to_dict()
+    key = find[0].fingerprint
+    assert stats[key]['calls'] == 3
+    assert stats[key]['rows'] == 3
+    assert stats[key]['latency_us']['max'] >= stats[key]['latency_us']['p50']
+    text = collector.to_prometheus()
+    assert 'sqlmapper_query_seconds_count{fingerprint="' in text
+    assert 'operation="find"} 3' in text
+
+    db.remove_listener(collector)
+    list(db.book.find())
+    assert collector.to_dict()[key]['calls'] == 3
+    db.close()
+
+
+def test_sqlite_instrument_lazy():
+    events = []
+    db = Connection(engine='sqlite', result_cache=MemoryCache())
+    db.book.add_column('id', 'int', primary=True, auto_increment=True)
+    db.book.add_column('value', 'int')
+    db.book.insert_many([{'value': i} for i in range(10)])
+    db.commit()
+    db.add_listener(events.append)
+
+    # waiting before iteration isn't build time
+    rows = db.book.find()
+    time.sleep(0.1)
+    assert len(list(rows)) == 10
+    assert events[-1].build_time < 0.05
+
+    assert len(list(db.book.find(cache=True))) == 10
+    assert events[-1].rows == 10
+    db.close()
+
+
+def test_sqlite_slow_log():
+    records = []
+    db = Connection(engine='sqlite')
+    db.book.add_column('id', 'int', primary=True, auto_increment=True)
+    db.book.add_column('value', 'int')
+    db.book.insert_many([{'value': i} for i in range(10)])
+    slow = SlowQueryLog(db, threshold=0, max_explains=2, on_record=records.append)
+    db.add_listener(slow)
+
+    db.book.find_one({'value': 5})
+    db.book.find_one({'value': 6})
+    db.book.find_one(3)
+    db.book.count()
+    db.book.insert({'value': 1})  # not in operations
+
+    assert len(records) == 4
+    assert records[0]['operation'] == 'find'
+    assert records[0]['params'] == ('int',)
+    assert 'SCAN' in records[0]['plan'][0]['detail']
+    assert records[1]['plan'] is None  # the same fingerprint
+    assert 'USING INTEGER PRIMARY KEY' in records[2]['plan'][0]['detail']
+    assert records[3]['plan'] is None  # max_explains
+    assert len(slow.records) == 4
+    db.commit()
+    db.close()
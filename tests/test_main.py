@@ -1,6 +1,7 @@
 
 import pytest
-from sqlmapper import Connection
+from collections import namedtuple
+from sqlmapper import Connection, Row
 
 
 def test_mysql():
@@ -15,6 +16,18 @@ def test_sqlite():
     main(Connection(engine='sqlite'))
 
 
+def test_sqlite_insert_ids():
+    db = Connection(engine='sqlite')
+    db.book.add_column('id', 'int', primary=True, auto_increment=True)
+    db.book.add_column('value', 'int')
+    assert db.book.insert_many([{'value': 1}, {'value': 2}]) == [1, 2]
+    assert db.book.insert_many([{'id': None, 'value': 3}, {'id': None, 'value': 4}]) == [3, 4]
+    # ids generated next to explicit ones aren't known
+    assert db.book.insert_many([{'id': 10, 'value': 5}, {'id': None, 'value': 6}]) == [10, None]
+    assert [d['id'] for d in db.book.find({'value': 6})] == [11]
+    db.close()
+
+
 def main(db):
     db.book.drop()
     db.ref.drop()
@@ -26,6 +39,9 @@ def main(db):
 
     assert len(db.book.describe()) == 3
     assert db['book'].get_column('value')['name'] == 'value'
+    assert db.book.get_primary_key() == 'id'
+    with pytest.raises(TypeError):
+        db.book.describe()[0]['name'] = 'name'
     assert 'book' in db
 
     db.book.insert({'name': 'ubuntu', 'value': 16})
@@ -75,7 +91,51 @@ def main(db):
     
     assert dd.status == 5
 
+    r = list(db.book.find(order_by='id', fetch_size=3))
+    assert len(r) == 8
+    assert r[7]['value'] == 14
+    assert r == list(db.book.find(order_by='id', stream=True))
+
+    d = db.book.find_one(3, row_type=Row)
+    assert d['value'] == 9 and d.name == 'debian' and d == {'id': 3, 'name': 'debian', 'value': 9}
+    assert db.book.find_one(3, row_type=namedtuple).value == 9
+    assert db.book.find_one(3, columns=['name', 'value'], row_type=tuple) == ('debian', 9)
+
     assert db.book.find_one(3)['value'] == 9
+    assert db.book.find_one(3)['value'] == 9
+    assert db.book is db['book']
+
+    assert db.book.increment(1, 'value') == 17
+    assert db.book.increment({'name': 'redhat'}, 'value', 10) == 15
+    db.book.update({'name': 'redhat'}, inc={'value': -10})
+    db.book.update(1, {'name': 'ubuntu'}, inc={'value': -1})
+    assert db.book.increment(100, 'value') is None
+    assert db.book.increment(1, 'value', 0) == 16
+    assert db.book.increment(3, 'value', -20) == -11
+    assert db.book.increment(3, 'value', 20) == 9
+    db.commit()
+    assert db.book.find_one(1)['value'] == 16
+    assert db.book.find_one({'name': 'redhat'})['value'] == 5
+
+    r = db.book.find_many([1, 3, 3, 100])
+    assert sorted(r) == [1, 3]
+    assert r[3]['value'] == 9
+    r = db.book.find_many(['mint', 'redhat'], key='name', columns='value')
+    assert r == {'mint': {'name': 'mint', 'value': 18}, 'redhat': {'name': 'redhat', 'value': 5}}
+
+    db.book.temp_table_threshold = 2
+    r = db.book.find_many([1, 2, 3, 100])
+    assert sorted(r) == [1, 2, 3]
+    assert r[2]['name'] == 'mint'
+    r = db.book.find_many(['mint', 'redhat', 'none'], key='name', columns='value')
+    assert sorted(r) == ['mint', 'redhat']
+    del db.book.temp_table_threshold
+
+    r = list(db.book.iterate_chunks(chunk_size=3, chunks=True))
+    assert [len(c) for c in r] == [3, 3, 2]
+    assert [d['id'] for c in r for d in c] == list(range(1, 9))
+    r = list(db.book.iterate_chunks({'name': 'ubuntu'}, chunk_size=2, columns='value'))
+    assert r == [{'id': 1, 'value': 16}, {'id': 7, 'value': 18}, {'id': 8, 'value': 14}]
 
     db.book.delete({'name': 'macos'})
     assert db.book.count() == 7
@@ -88,6 +148,26 @@ def main(db):
     assert r[1]['name'] == 'debian'
     assert r[1]['count_value'] == 2
 
+    r = db.book.find(group_by='name', columns=['name', 'SUM(value)'], order_by='name', as_columns='array')
+    assert list(r['name']) == ['debian', 'mint', 'redhat', 'ubuntu']
+    assert list(r['sum_value']) == [17, 18, 5, 48]
+    r = db.book.find(order_by='id', as_columns='array', fetch_size=3)
+    assert r['value'].typecode == 'q' and len(r['value']) == 7
+
+    db.book.upsert([{'id': 2, 'name': 'mint', 'value': 19}, {'id': 9, 'name': 'arch', 'value': 1}])
+    db.book.upsert({'id': 9, 'name': 'manjaro', 'value': 2}, update=['value'])
+    db.commit()
+    assert db.book.find_one(2)['value'] == 19
+    assert db.book.find_one(9) == {'id': 9, 'name': 'arch', 'value': 2}
+    db.book.delete(9)
+    db.book.upsert({'id': 2, 'name': 'mint', 'value': 18})
+    db.commit()
+    # a key repeated in a batch, the last row wins
+    db.book.upsert([{'id': 9, 'name': 'arch', 'value': 1}, {'id': 9, 'name': 'arch', 'value': 3}])
+    assert db.book.find_one(9)['value'] == 3
+    db.book.delete(9)
+    db.commit()
+
     db.book.add_column('ext', 'int', exist_ok=True)
     assert len(db.book.describe()) == 4
 
@@ -122,6 +202,26 @@ def main(db):
     r = list(db.ref.find(left_join='book.id=book_id', order_by='ref.id'))
     assert len(r) == 5
     assert r[3]['book'] is None
+
+    r = list(db.ref.find(left_join='book.id=book_id', order_by='ref.id', row_type=Row))
+    assert r[1].book['value'] == 18
+    assert r[3].book is None
+
+    ids = db.ref.insert_many([{'book_id': 2}, {'book_id': 3}] * 3, batch_size=4)
+    assert ids == [6, 7, 8, 9, 10, 11]
+    assert db.ref.count() == 11
+    assert db.ref.find_one(11)['book_id'] == 3
+    assert db.ref.insert_many([{'id': 20, 'book_id': 1}]) == [20]
+    db.commit()
+
+    # every result is read by its own cursor, nested queries and writes don't replace it
+    result = []
+    for ref in db.ref.find({'book_id': 3}, order_by='id'):
+        book = db.book.find_one(ref['book_id'])
+        db.ref.update(ref['id'], {'book_id': 3})
+        result.append((ref['id'], book['id']))
+    assert result == [(3, 3), (7, 3), (9, 3), (11, 3)]
+    db.commit()
     db.close()
 
 
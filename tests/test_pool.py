@@ -0,0 +1,129 @@
+import time
+import threading
+import pytest
+from sqlmapper.pool import Pool, PoolTimeout
+from sqlmapper.base_engine import BaseEngine
+
+
+class Conn(object):
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Cursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class EngineConn(Conn):
+    fail_rollback = False
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        if self.fail_rollback:
+            raise IOError('connection lost')
+
+
+class Engine(BaseEngine):
+    def __init__(self, **kw):
+        super(Engine, self).__init__()
+        self.init_pool(EngineConn, kw)
+
+    def ping_connection(self, conn):
+        return not conn.closed
+
+
+def test_pool():
+    pool = Pool(Conn, max_size=2, min_idle=1, timeout=0.1)
+    assert pool.size == 1
+
+    a = pool.acquire()
+    b = pool.acquire()
+    assert a is not b
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+
+    pool.release(a)
+    assert pool.acquire() is a
+
+    pool.release(b, discard=True)
+    assert b.closed
+    assert pool.size == 2  # min_idle
+    assert len(pool.idle) == 1
+
+    pool.release(a)
+    pool.close()
+    assert pool.size == 0
+    assert a.closed
+
+
+def test_pool_lifetime():
+    pool = Pool(Conn, max_size=1, idle_timeout=0.05, ping=lambda conn: not conn.closed)
+    a = pool.acquire()
+    pool.release(a)
+    time.sleep(0.1)
+    b = pool.acquire()
+    assert b is not a and a.closed
+
+    pool.release(b)
+    b.closed = True
+    c = pool.acquire()
+    assert c is not b
+
+
+def test_pool_wait():
+    pool = Pool(Conn, max_size=1)
+    a = pool.acquire()
+    result = []
+
+    def run():
+        result.append(pool.acquire())
+
+    t = threading.Thread(target=run)
+    t.start()
+    time.sleep(0.05)
+    assert not result
+    pool.release(a)
+    t.join()
+    assert result == [a]
+
+
+def test_engine_pool():
+    engine = Engine(pool_size=2)
+    cursor = engine.acquire_cursor()
+    conn = cursor.conn
+    assert engine.get_conn() is conn and engine.pool.size == 1
+    engine.release_cursor(cursor)
+    assert id(conn) in engine.local.cursors
+
+    # the connection is returned to the pool with the end of the transaction, its cursors are closed
+    engine.commit()
+    assert engine.local.conn is None
+    assert id(conn) not in engine.local.cursors and cursor.closed
+    assert [c for c, _, _ in engine.pool.idle] == [conn]
+    assert engine.get_conn() is conn
+
+    engine.rollback()
+    assert engine.get_conn() is conn
+
+    # a connection which can't be rolled back is closed
+    engine.release_cursor(engine.acquire_cursor())
+    conn.fail_rollback = True
+    with pytest.raises(IOError):
+        engine.rollback()
+    assert conn.closed
+    assert engine.local.conn is None and not engine.local.cursors
+    assert engine.pool.size == 0
+    assert engine.get_conn() is not conn
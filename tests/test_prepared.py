@@ -0,0 +1,57 @@
+from sqlmapper.prepared import PreparedStatements, numbered_params, execute_sql
+
+
+class FakeCursor(object):
+    def __init__(self, fail=()):
+        self.sql = []
+        self.fail = fail
+
+    def execute(self, sql, values=None):
+        self.sql.append(sql)
+        for text in self.fail:
+            if text in sql:
+                raise Exception('syntax error')
+
+
+def test_numbered_params():
+    assert numbered_params('SELECT * FROM "t" WHERE "id" = %s AND x %% 2 = %s') == 'SELECT * FROM "t" WHERE "id" = $1 AND x % 2 = $2'
+    # literals aren't parsed
+    assert numbered_params("SELECT * FROM t WHERE name LIKE 'a%%' AND id = %s") is None
+    assert numbered_params("SELECT * FROM t WHERE name = '%s'") is None
+    assert numbered_params('SELECT $$%s$$') is None
+    assert numbered_params('SELECT %(name)s') is None
+    assert execute_sql('s1', 2) == 'EXECUTE s1 (%s, %s)'
+    assert execute_sql('s1', 0) == 'EXECUTE s1'
+
+
+def test_prepared_statements():
+    cursor = FakeCursor(fail=['bad'])
+    statements = PreparedStatements(max_size=2)
+    assert statements.prepare(cursor, 'SELECT * FROM t WHERE id = %s') == 'sqlmapper_1'
+    assert cursor.sql == ['SAVEPOINT sqlmapper_prepare; PREPARE sqlmapper_1 AS SELECT * FROM t WHERE id = $1; RELEASE SAVEPOINT sqlmapper_prepare']
+    assert statements.lookup('SELECT * FROM t WHERE id = %s') == 'sqlmapper_1'
+
+    # a failed statement is rolled back to the savepoint and isn't tried again
+    del cursor.sql[:]
+    assert statements.prepare(cursor, 'SELECT bad FROM t WHERE id = %s') is None
+    assert cursor.sql[-1] == 'ROLLBACK TO SAVEPOINT sqlmapper_prepare'
+    assert statements.prepare(cursor, 'SELECT bad FROM t WHERE id = %s') is None
+    assert statements.prepare(cursor, 'CREATE TABLE t (id int)') is None
+    assert statements.prepare(cursor, "SELECT * FROM t WHERE name = '%s'") is None
+    assert len(cursor.sql) == 2
+
+    # LRU
+    del cursor.sql[:]
+    assert statements.prepare(cursor, 'UPDATE t SET a = %s WHERE id = %s', in_transaction=False) == 'sqlmapper_3'
+    assert statements.lookup('SELECT * FROM t WHERE id = %s') == 'sqlmapper_1'
+    assert statements.prepare(cursor, 'DELETE FROM t WHERE id = %s', in_transaction=False) == 'sqlmapper_4'
+    assert cursor.sql == [
+        'PREPARE sqlmapper_3 AS UPDATE t SET a = $1 WHERE id = $2',
+        'PREPARE sqlmapper_4 AS DELETE FROM t WHERE id = $1',
+        'DEALLOCATE sqlmapper_3'
+    ]
+    assert list(statements.names.values()) == ['sqlmapper_1', 'sqlmapper_4']
+
+    statements.reset(cursor, 1)
+    assert cursor.sql[-1] == 'DEALLOCATE ALL'
+    assert not statements.names and statements.generation == 1
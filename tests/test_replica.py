@@ -0,0 +1,152 @@
+import time
+from sqlmapper.base_engine import BaseEngine
+from sqlmapper.table import Table
+
+
+class Cursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+        self.rowcount = 0
+        self.lastrowid = 1
+        self.description = (('host',),)
+
+    def execute(self, sql, values=None):
+        self.conn.log.append((self.conn.host, sql.split()[0]))
+        self.rows = [(self.conn.host,)]
+        self.rowcount = 1
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        pass
+
+
+class Conn(object):
+    def __init__(self, host, log):
+        self.host = host
+        self.log = log
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Engine(BaseEngine):
+    def __init__(self, replicas, down=(), **kw):
+        self.log = []
+        self.down = down
+        self.db_config = {'host': 'primary'}
+        super(Engine, self).__init__()
+        self.init_replicas(replicas, kw)
+
+    def get_connection(self):
+        return Conn('primary', self.log)
+
+    def get_replica_connection(self, config):
+        if config['host'] in self.down:
+            raise IOError('down')
+        return Conn(config['host'], self.log)
+
+    def ping_connection(self, conn):
+        return True
+
+    def get_cursor(self):
+        cursor = getattr(self.local, 'cursor', None)
+        if cursor is None:
+            cursor = self.local.cursor = self.get_conn().cursor()
+        return cursor
+
+    def create_table(self, name):
+        return Table(name, self)
+
+    def load_columns(self, table):
+        return [{'name': 'id', 'primary': True}]
+
+
+def test_replica_routing():
+    engine = Engine(['r1', 'r2:3307'], replica_lag=0.2)
+    book = engine.get_table('book')
+
+    hosts = [book.count() for i in range(4)]
+    assert hosts == ['r1', 'r2', 'r1', 'r2']
+    assert book.find_one(1)['host'] == 'r1'
+    assert book.find_one(1, for_update=True)['host'] == 'primary'
+    # a locked row pins the transaction to the primary
+    assert book.count() == 'primary'
+    engine.rollback()
+    assert book.count() in ('r1', 'r2')
+
+    # read your writes: the primary till commit and replica_lag after it
+    book.update(1, {'value': 1})
+    assert book.count() == 'primary'
+    engine.commit()
+    assert book.count() == 'primary'
+    time.sleep(0.25)
+    assert book.count() in ('r1', 'r2')
+
+    # a rollback doesn't pin to the primary
+    book.update(1, {'value': 1})
+    engine.rollback()
+    assert book.count() in ('r1', 'r2')
+    engine.close()
+
+
+def test_replica_select():
+    engine = Engine(['r1', 'r2', 'r3'], down=('r2',), replica_select='latency')
+    book = engine.get_table('book')
+    replicas = dict((r.name, r) for r in engine.replicas.replicas)
+    assert [book.count() for i in range(2)] == ['r1', 'r3']
+    replicas['r1'].latency = 0.5
+    replicas['r3'].latency = 0.1
+    assert book.count() == 'r3'
+
+    # all replicas are down, reads go to the primary
+    engine.down = ('r1', 'r2', 'r3')
+    for r in replicas.values():
+        r.pool.close()
+    assert book.count() == 'primary'
+
+
+def test_replica_latency():
+    engine = Engine(['r1'])
+    book = engine.get_table('book')
+    replica = engine.replicas.replicas[0]
+    for row in book.find():
+        # reading of rows by the application isn't latency of the replica
+        time.sleep(0.1)
+    assert row['host'] == 'r1'
+    assert replica.latency < 0.05
+
+
+def test_replica_identity_map():
+    engine = Engine(['r1'])
+    engine.identity_map = True
+    book = engine.get_table('book')
+
+    # a replica read isn't in a transaction, it's not mapped
+    assert book.find_one(1)['host'] == 'r1'
+    assert book.find_one(1)['host'] == 'r1'
+    assert len(engine.log) == 2
+
+    book.update(2, {'value': 1})
+    row = book.find_one(1)
+    assert row['host'] == 'primary'
+    assert book.find_one(1) is row
+    assert len(engine.log) == 4
+    engine.commit()
+    assert engine.local.identity is None
+    engine.close()
@@ -1,7 +1,10 @@
 
+import gc
 import time
+import sqlite3
+import pytest
 import threading
-from sqlmapper import Connection
+from sqlmapper import Connection, TableQueue
 
 
 def get_db():
@@ -77,3 +80,246 @@ def test_threading1():
     
     assert db.book.find_one(1)['value'] == 30
     assert result == ['5', '6', '7', '8', '9', '10', '11', '12', '13', '14', '15', '16', '17', '18', '19', '20', '21', '22', '23', '24', '25', '26', '27', '28', '29']
+
+
+def test_threading2():
+    db = get_db()
+    result = []
+
+    def run():
+        for i in range(5):
+            result.append(db.book.increment(1, 'value'))
+            db.commit()
+
+    threads = [threading.Thread(target=run) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert db.book.find_one(1)['value'] == 30
+    assert sorted(result) == list(range(6, 31))
+
+
+def test_queue():
+    db = get_db()
+    db.book.insert_many([{'value': i} for i in range(6, 16)])
+    db.commit()
+
+    result = []
+    released = []
+    queue = TableQueue(db, 'book', filter=('value > %s', 0), order_by='id', done={'value': 0}, on_release=released.extend)
+
+    def run():
+        with queue.claim(3) as rows:
+            result.append([d['value'] for d in rows])
+            time.sleep(0.2)
+
+    threads = [threading.Thread(target=run) for i in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(result) == [[5, 6, 7], [8, 9, 10], [11, 12, 13]]
+    assert db.book.count({'value': 0}) == 9
+
+    with pytest.raises(ValueError):
+        with queue.claim(10):
+            raise ValueError
+    assert [d['value'] for d in released] == [14, 15]
+    assert queue.process(lambda rows: None, 10) == 2
+    assert db.book.count({'value': 0}) == 11
+
+
+def check_chunks_snapshot(db):
+    db.book.insert_many([{'value': i} for i in range(10)])
+    db.commit()
+    result = []
+
+    def insert():
+        db.book.insert({'value': 100})
+        db.commit()
+
+    for row in db.book.iterate_chunks(chunk_size=2):
+        if not result:
+            t = threading.Thread(target=insert)
+            t.start()
+            t.join()
+        result.append(row['value'])
+    # a row committed after the scan has started is read by a next chunk
+    assert result[-1] == 100
+
+
+def test_iterate_chunks_snapshot():
+    db = get_db()
+    check_chunks_snapshot(db)
+
+
+def test_sqlite_iterate_chunks_snapshot(tmp_path):
+    db = Connection(engine='sqlite', db=str(tmp_path / 'test.db'))
+    db.book.add_column('id', 'int', primary=True, auto_increment=True)
+    db.book.add_column('value', 'int')
+    check_chunks_snapshot(db)
+    db.close()
+
+
+def test_sqlite_threading(tmp_path):
+    db = Connection(engine='sqlite', db=str(tmp_path / 'test.db'), synchronous='normal')
+    db.book.add_column('id', 'int', primary=True, auto_increment=True)
+    db.book.add_column('value', 'int')
+    db.book.insert({'value': 5})
+    db.commit()
+
+    def run():
+        for i in range(5):
+            assert db.book.find_one(1)['value'] >= 5
+            db.book.update(1, inc={'value': 1})
+            db.commit()
+
+    threads = [threading.Thread(target=run) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert db.book.find_one(1)['value'] == 30
+
+    # readers don't see an uncommitted write
+    db.book.update(1, {'value': 100})
+    result = []
+    t = threading.Thread(target=lambda: result.append(db.book.find_one(1)['value']))
+    t.start()
+    t.join()
+    assert result == [30]
+    assert db.book.find_one(1)['value'] == 100
+    db.commit()
+    db.close()
+
+
+def test_sqlite_thread_exit(tmp_path):
+    db = Connection(engine='sqlite', db=str(tmp_path / 'test.db'), timeout=0.2)
+    db.book.add_column('id', 'int', primary=True, auto_increment=True)
+    db.book.add_column('value', 'int')
+    db.book.insert({'value': 1})
+    db.commit()
+
+    # a reader is closed when its thread exits
+    assert db.book.count() == 1
+    readers = list(db._engine.readers.values())
+    result = []
+    threads = [threading.Thread(target=lambda: result.append(db.book.count())) for i in range(50)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    del threads, t
+    gc.collect()
+    assert result == [1] * 50
+    assert list(db._engine.readers.values()) == readers
+
+    # a thread exits in a transaction, the writer is rolled back and taken over
+    t = threading.Thread(target=lambda: db.book.insert({'value': 2}))
+    t.start()
+    t.join()
+    db.book.insert({'value': 3})
+    db.commit()
+    assert [d['value'] for d in db.book.find()] == [1, 3]
+
+    # the writer is busy, hooks of the transaction are run
+    result = []
+    db.book.insert({'value': 4})
+
+    def write():
+        db.on_rollback(lambda: result.append('rollback'))
+        try:
+            db.book.insert({'value': 5})
+        except sqlite3.OperationalError:
+            result.append('locked')
+    t = threading.Thread(target=write)
+    t.start()
+    t.join()
+    db.commit()
+    assert result == ['rollback', 'locked']
+    assert db.book.count() == 3
+    db.close()
+
+
+def test_sqlite_raw_cursor(tmp_path):
+    db = Connection(engine='sqlite', db=str(tmp_path / 'test.db'))
+    db.book.add_column('id', 'int', primary=True, auto_increment=True)
+    db.book.add_column('value', 'int')
+    db.commit()
+
+    # a raw write is a part of the transaction and holds the writer
+    db.cursor.execute('INSERT INTO book (value) VALUES (1)')
+    result = []
+
+    def write():
+        db.book.insert({'value': 2})
+        result.append(db.book.count())
+        db.commit()
+
+    t = threading.Thread(target=write)
+    t.start()
+    time.sleep(0.1)
+    assert result == []
+    db.rollback()
+    t.join()
+    assert result == [1]
+    assert db.book.find_one({'value': 1}) is None
+    db.close()
+
+
+def test_sqlite_memory_visibility():
+    # one connection for all threads, an uncommitted write is visible
+    db = Connection(engine='sqlite')
+    db.book.add_column('id', 'int', primary=True, auto_increment=True)
+    db.book.add_column('value', 'int')
+    db.commit()
+    db.book.insert({'value': 1})
+    result = []
+    t = threading.Thread(target=lambda: result.append(db.book.count()))
+    t.start()
+    t.join()
+    assert result == [1]
+    db.rollback()
+    assert db.book.count() == 0
+    db.close()
+
+
+def test_sqlite_find_many_threads():
+    db = Connection(engine='sqlite')
+    db.book.add_column('id', 'int', primary=True, auto_increment=True)
+    db.book.add_column('value', 'int')
+    db.book.insert_many([{'value': i} for i in range(100)])
+    db.commit()
+    db.book.temp_table_threshold = 10
+    errors = []
+
+    def run(n):
+        try:
+            for i in range(20):
+                ids = list(range(n, n + 50))
+                assert sorted(db.book.find_many(ids)) == ids
+                # in a write transaction ids are loaded to a temporary table of the writer
+                db.book.update(n, {'value': i})
+                assert sorted(db.book.find_many(ids)) == ids
+                db.commit()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(1, 6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+
+    # chunks are padded to a power of two, sql of find_many has a few shapes
+    del db.book.temp_table_threshold
+    db.book.in_size = 16
+    db._engine.sql_cache.data.clear()
+    for n in range(1, 40):
+        assert len(db.book.find_many(range(1, n + 1))) == n
+    assert len([k for k in db._engine.sql_cache.data if k[0] == 'find' and k[1] == 'book']) == 5
+    db.close()